@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+'''
+Benchmark metascons on synthetic suites
+=======================================
+
+Generate a suite of synthetic wrapper modules and a configuration
+file, then time how long metascons takes to:
+
+* resolve_package_objects(),
+* resolve_dependencies(),
+* dump_environment(),
+* resolve the layered environment of every package (see
+  metascons.layered) and
+* load the dumped environment with metasconsenv.py (with and without
+  its cache)
+
+along with the peak memory used.  With --build the no-op stages
+("date > $TARGET") are also run.  Nothing is downloaded.
+
+Each result is appended as a JSON line to the results file along with
+the git revision so each run is compared with the previous one for
+the same scenario on the same host.
+
+usage: python bench/bench.py [options] [scenario ...]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import platform
+import optparse
+import tempfile
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+
+# name: (packages, depth, diamonds, path size)
+scenarios = {
+    'small': (50, 5, 0.3, 5),
+    'medium': (300, 10, 0.3, 10),
+    'large': (1000, 20, 0.3, 20),
+    }
+
+wrapper_template = '''
+import os
+from metascons.wrapper import MetaSconsWrapper
+
+class SyntheticWrapper(MetaSconsWrapper):
+    deps = %(deps)r
+    npaths = %(npaths)d
+
+    def set_env(self, env):
+        MetaSconsWrapper.set_env(self, env)
+        base = os.path.join(env['INSTALL_AREA'], self.name())
+        env['CPPPATH'] = [os.path.join(base, 'include%%d' %% n) \\
+                              for n in range(self.npaths)]
+        # this one reaches the commands, keep it below the size limit
+        env['ENV']['LD_LIBRARY_PATH'] = [os.path.join(base, 'lib')]
+        return
+
+    def dependencies(self):
+        return self.deps
+
+    def download_action(self):
+        return 'date > $TARGET'
+
+    def unpack_action(self):
+        return 'date > $TARGET'
+
+    def environment(self):
+        inst = self.installdir()
+        return {
+            'PATH': [os.path.join(inst, 'bin%%d' %% n) for n in range(self.npaths)],
+            'LD_LIBRARY_PATH': [os.path.join(inst, 'lib%%d' %% n) \\
+                                    for n in range(self.npaths)],
+            self.name().upper() + '_HOME': inst,
+            }
+
+    pass
+
+wrapper = SyntheticWrapper()
+'''
+
+def generate(workdir, npackages, depth, diamonds, npaths, seed=1):
+    '''
+    Write npackages wrapper modules in depth levels, each depending on
+    one package of the level below plus, with probability diamonds
+    each, up to three more from any lower level.  A "bsuite" package
+    depends on all packages nothing else depends on.  Return the
+    configuration file name.
+    '''
+    rand = random.Random(seed)
+    wdir = os.path.join(workdir, 'wrappers')
+    os.makedirs(wdir)
+
+    depth = max(1, min(depth, npackages))
+    levels = [[] for n in range(depth)]
+    for ind in range(npackages):
+        levels[ind * depth // npackages].append('bp%04d' % ind)
+        continue
+
+    deps = {}
+    used = set()
+    for lev,names in enumerate(levels):
+        below = sum(levels[:lev], [])
+        for name in names:
+            mine = []
+            if lev:
+                mine.append(rand.choice(levels[lev-1]))
+                while len(mine) < 4 and rand.random() < diamonds:
+                    dep = rand.choice(below)
+                    if dep not in mine:
+                        mine.append(dep)
+                    continue
+                pass
+            used.update(mine)
+            deps[name] = mine
+            continue
+        continue
+    deps['bsuite'] = sorted(set(deps.keys()) - used)
+
+    for name,mine in deps.iteritems():
+        fp = open(os.path.join(wdir, name + '.py'), 'w')
+        fp.write(wrapper_template % {'deps': mine, 'npaths': npaths})
+        fp.close()
+        continue
+
+    cfg = os.path.join(workdir, 'bench.cfg')
+    fp = open(cfg, 'w')
+    fp.write('[DEFAULTS]\n')
+    for item in ['build_area','tar_files','install_area']:
+        fp.write('%s = %s\n' % (item, os.path.join(workdir, item)))
+    fp.write('web_cache_url = http://localhost/\n')
+    fp.write('wrapper_path = %s\n' % wdir)
+    fp.write('packages = bsuite\n\n[versions]\n')
+    for name in sorted(deps):
+        fp.write('%s = 1.0\n' % name)
+    fp.close()
+    return cfg
+
+def run(cmd, cwd=None):
+    '''
+    Run the command and return its output, wall time and peak memory
+    in kB.
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(top, 'python')] + \
+                                            env.get('PYTHONPATH','').split(os.pathsep))
+    start = time.time()
+    proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    out = proc.stdout.read()
+    pid, status, ru = os.wait4(proc.pid, 0)
+    wall = time.time() - start
+    proc.returncode = status
+    if status:
+        sys.stderr.write(out)
+        raise RuntimeError('Failed (%d): %s' % (status, ' '.join(cmd)))
+    return out, wall, ru.ru_maxrss
+
+def bench_once(opts, workdir, cfg):
+    'Run all the timings once and return a dictionary of results'
+    envfile = os.path.join(workdir, 'env.json')
+    scons = [opts.scons, '-Q', '-f', os.path.join(here, 'bench.scons'),
+             '--metascons-file=%s' % os.path.join(top, 'metascons.scons'),
+             '--build-config=%s' % cfg, '--environment-file=%s' % envfile]
+
+    out, wall, rss = run(scons + ['-n'], workdir)
+    line = [l for l in out.split('\n') if l.startswith('BENCH ')][-1]
+    res = json.loads(line[len('BENCH '):])
+    res['scons_dry_run'] = wall
+
+    envpy = [sys.executable, os.path.join(top, 'metasconsenv.py')]
+    out, wall, rss = run(envpy + ['-n', envfile])
+    res['metasconsenv'] = wall
+    res['metasconsenv_maxrss_kb'] = rss
+    cache = os.path.join(workdir, 'envcache')
+    run(envpy + ['-c', cache, envfile])
+    out, wall, rss = run(envpy + ['-c', cache, envfile])
+    res['metasconsenv_cached'] = wall
+
+    if opts.build:
+        for item in ['build_area','tar_files','install_area']:
+            shutil.rmtree(os.path.join(workdir, item), True)
+        sconsign = os.path.join(workdir, '.sconsign.dblite')
+        if os.path.exists(sconsign):
+            os.remove(sconsign)
+        out, wall, rss = run(scons + ['-j%d' % opts.jobs], workdir)
+        res['scons_build'] = wall
+    return res
+
+def best(runs):
+    'Combine repeated runs taking the least time and the most memory'
+    ret = {}
+    for key in runs[0]:
+        vals = [r[key] for r in runs]
+        if key.endswith('_kb'):
+            ret[key] = max(vals)
+        else:
+            ret[key] = min(vals)
+        continue
+    return ret
+
+def revision():
+    'Return the git revision of the tree, marked if it has changes'
+    try:
+        rev = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], cwd=top,
+                               stdout=subprocess.PIPE).communicate()[0].strip()
+        dirty = subprocess.Popen(['git', 'status', '--porcelain', '-uno'],
+                                 cwd=top, stdout=subprocess.PIPE).communicate()[0]
+    except OSError:
+        return 'unknown'
+    if dirty.strip():
+        rev += '+'
+    return rev
+
+def previous(path, entry):
+    'Return the last stored result comparable with entry or None'
+    if not os.path.exists(path): return None
+    last = None
+    for line in open(path):
+        try:
+            old = json.loads(line)
+        except ValueError:
+            continue
+        if [old.get(k) for k in ['scenario','params','host']] == \
+                [entry[k] for k in ['scenario','params','host']]:
+            last = old
+        continue
+    return last
+
+def report(entry, last, threshold):
+    'Print the results and their change since the last stored ones'
+    print '\n%s %s at %s' % (entry['scenario'], entry['params'], entry['revision'])
+    fmt = '  %-26s %12s %12s %8s %s'
+    print fmt % ('', 'now', 'before', 'change', '')
+    for key,val in sorted(entry['results'].iteritems()):
+        before = last and last['results'].get(key)
+        change = flag = ''
+        if before:
+            frac = float(val - before) / before
+            change = '%+.0f%%' % (100 * frac)
+            if frac > threshold and key != 'packages':
+                flag = 'SLOWER' if not key.endswith('_kb') else 'BIGGER'
+            pass
+        if isinstance(val, float):
+            val = '%.3f' % val
+            before = before and '%.3f' % before
+        print fmt % (key, val, before or '', change, flag)
+        continue
+    if last:
+        print '  (before: %s on %s)' % (last['revision'], last['date'])
+    return
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.split('usage: ')[-1].strip())
+    parser.add_option('-n','--packages', type='int', default=None,
+                      help='Number of packages, overriding the scenario')
+    parser.add_option('-d','--depth', type='int', default=None,
+                      help='Number of dependency levels, overriding the scenario')
+    parser.add_option('--diamonds', type='float', default=None,
+                      help='Chance of each extra dependency, overriding the scenario')
+    parser.add_option('-p','--path-size', type='int', default=None,
+                      help='Entries per PATH-like variable, overriding the scenario')
+    parser.add_option('-r','--repeat', type='int', default=3,
+                      help='Number of runs to take the best of (def=%default)')
+    parser.add_option('-b','--build', default=False, action='store_true',
+                      help='Also run the (no-op) stages')
+    parser.add_option('-j','--jobs', type='int', default=4,
+                      help='Number of scons jobs for --build (def=%default)')
+    parser.add_option('--scons', default='scons',
+                      help='The scons command (def=%default)')
+    parser.add_option('--results', default=os.path.join(here, 'results.jsonl'),
+                      help='File collecting results (def=%default)')
+    parser.add_option('--no-store', default=False, action='store_true',
+                      help='Do not add these results to the results file')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='Fractional change flagged as a regression (def=%default)')
+    parser.add_option('-k','--keep', default=False, action='store_true',
+                      help='Keep the generated suites')
+    opts, args = parser.parse_args()
+
+    for name in args or ['small']:
+        if not scenarios.has_key(name):
+            parser.error('Unknown scenario "%s", known: %s' % \
+                             (name, ', '.join(sorted(scenarios))))
+        params = list(scenarios[name])
+        for ind,val in enumerate([opts.packages, opts.depth, opts.diamonds,
+                                  opts.path_size]):
+            if val is not None:
+                params[ind] = val
+            continue
+        workdir = tempfile.mkdtemp(prefix='metascons-bench-')
+        try:
+            cfg = generate(workdir, *params)
+            runs = [bench_once(opts, workdir, cfg) for n in range(opts.repeat)]
+        finally:
+            if opts.keep:
+                print 'Suite kept in', workdir
+            else:
+                shutil.rmtree(workdir)
+        entry = {'scenario': name, 'host': platform.node(),
+                 'params': dict(zip(['packages','depth','diamonds','path_size'],
+                                    params)),
+                 'build': opts.build,
+                 'revision': revision(),
+                 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                 'results': best(runs)}
+        report(entry, previous(opts.results, entry), opts.threshold)
+        if not opts.no_store:
+            fp = open(opts.results, 'a')
+            fp.write(json.dumps(entry, sort_keys=True) + '\n')
+            fp.close()
+        continue
+    return
+
+if '__main__' == __name__:
+    main()
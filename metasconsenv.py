@@ -5,12 +5,19 @@ by "metascons --environment-file=foo.txt"
 
 This script is meant to be run from a sh function or csh alias.  See
 mscenv.sh/.csh for examples.
+
+As it runs at every login its output is cached.  The cache is keyed on
+the shell, the environment files' names, sizes and modification times
+and the values in the user's environment of the variables they set.
 '''
 
 import os
 import sys
+import json
+import hashlib
 import optparse
-from metascons.util import merge_dict
+from metascons.util import merge_dict, PathList
+from metascons import envdump
 
 usage = 'usage: %prog [options] env.txt [...]'
 parser = optparse.OptionParser(usage=usage)
@@ -18,6 +25,13 @@ parser.add_option('-s','--shell', default='sh',
                   help='The shell to generate for (def=sh)')
 #parser.add_option('-u','--unset', default=False, action='store_true',
 #                  help='Unset the environment instead of setting it')
+parser.add_option('-c','--cache-dir',
+                  default=os.path.join(os.environ.get('XDG_CACHE_HOME') or \
+                                           os.path.expanduser('~/.cache'),
+                                       'metascons-env'),
+                  help='Directory caching the generated output (def=%default)')
+parser.add_option('-n','--no-cache', default=False, action='store_true',
+                  help='Do not use or update the cache')
 (opts,args) = parser.parse_args()
 
 if not args:
@@ -25,39 +39,67 @@ if not args:
     sys.stderr.write('No environment files given\n')
     sys.exit(1)
 
+def cache_path():
+    'Return the cache file for the shell and the environment files'
+    hasher = hashlib.sha1('%s\0%d\0' % (opts.shell.lower(), envdump.VERSION))
+    for envfile in args:
+        st = os.stat(envfile)
+        hasher.update('%s\0%d\0%r\0' % (os.path.abspath(envfile),
+                                         st.st_size, st.st_mtime))
+        continue
+    return os.path.join(opts.cache_dir, hasher.hexdigest() + '.json')
+
+def user_values(keys):
+    'Return the values of the variables in the user environment'
+    return [[key, os.environ.get(key)] for key in keys]
+
+cached = None
+if not opts.no_cache:
+    cached = cache_path()
+    try:
+        dat = json.load(open(cached))
+    except (IOError, ValueError):
+        pass
+    else:
+        if dat['user'] == user_values(dat['keys']):
+            sys.stdout.write(dat['output'].encode('utf-8'))
+            sys.exit(0)
+        pass
+    pass
+
 # Slurp in env files
 env = {}
 for envfile in args:
-    fp = open(envfile)
-    code = fp.read()
-    #print code
-    other_env = eval(code)
-    merge_dict(env,other_env)
+    merge_dict(env,envdump.load(envfile))
     continue
 
 # Get any user env that will be stepped on 
 user = {}
 for key in env.keys():
-    user[key] = os.environ.get(key)
+    if os.environ.has_key(key):
+        user[key] = os.environ[key]
+    continue
 
 # Merge the two and flatten any lists to strings
 merge_dict(user,env)
 for key,val in user.iteritems():
-    if type(val) == list:
-        user[key] = ':'.join(val)
+    if isinstance(val,(list,PathList)):
+        user[key] = str(PathList(val))
         pass
     continue
 
 def sh_munger(theenv):
-    for key,val in theenv.iteritems():
-        print 'export %s="%s"' % (key,val)
+    lines = []
+    for key,val in sorted(theenv.iteritems()):
+        lines.append('export %s="%s"\n' % (key,val))
         continue
-    return
+    return ''.join(lines)
 def cs_munger(theenv):
-    for key,val in theenv.iteritems():
-        print 'setenv %s "%s"' % (key,val)
+    lines = []
+    for key,val in sorted(theenv.iteritems()):
+        lines.append('setenv %s "%s"\n' % (key,val))
         continue
-    return
+    return ''.join(lines)
 
 envmunger = None
 if opts.shell.lower() in ['sh','bash']:
@@ -68,5 +110,20 @@ if not envmunger:
     parser.print_help()
     sys.stderr.write('Unknown shell: "%s"\n' % opts.shell)
     sys.exit(1)
-envmunger(user)
+output = envmunger(user)
+sys.stdout.write(output)
+
+if cached:
+    keys = sorted(env.keys())
+    try:
+        if not os.path.isdir(opts.cache_dir):
+            os.makedirs(opts.cache_dir)
+        tmp = '%s.tmp%d' % (cached, os.getpid())
+        fp = open(tmp,'w')
+        json.dump({'keys':keys, 'user':user_values(keys), 'output':output}, fp)
+        fp.close()
+        os.rename(tmp, cached)
+    except (IOError, OSError):
+        pass                    # caching is only an optimization
+    pass
 
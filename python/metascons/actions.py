@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+Signatures of action objects
+============================
+
+Stage actions are often callable objects: wrappers holding job slots,
+timing, dispatching or prefetching the action they wrap, and steps
+such as writing a manifest.  Each has a get_contents() method giving
+what should decide if the stage is redone, for a wrapper that of the
+wrapped action.
+
+SCons (3.x) does not ask them: a callable object is signed by the
+byte code of its __call__ method, the same for all instances, so a
+stage would not be redone when its command changed.  Actions made
+by scons_action() instead are signed by the object's get_contents()
+and have the implicit dependencies (eg, the program a command runs)
+of the action the object wraps, if any.  All actions handed to SCons
+by metascons go through it.
+'''
+
+import SCons.Action
+import SCons.Util
+
+class ObjectAction(SCons.Action.FunctionAction):
+    '''
+    A SCons function action calling a callable object, signed by the
+    object's get_contents().
+    '''
+    def __init__(self, obj, kw):
+        SCons.Action.FunctionAction.__init__(self, obj, kw)
+        self.gc = obj.get_contents      # what get_presig() calls if set
+        return
+
+    def get_implicit_deps(self, target, source, env):
+        'Those of the wrapped action, if the object wraps one'
+        inner = getattr(self.execfunction, 'action', None)
+        if not isinstance(inner, SCons.Action.ActionBase):
+            return []
+        return inner.get_implicit_deps(target, source, env)
+
+    pass
+
+def scons_action(act, **kw):
+    '''
+    Return the SCons action of act as SCons.Action.Action() does,
+    except that callable objects with a get_contents() method, also
+    in a list, are made ObjectActions.
+    '''
+    if SCons.Util.is_List(act):
+        return SCons.Action.Action([scons_action(a, **kw) for a in act])
+    if isinstance(act, SCons.Action.ActionBase) or not callable(act) or \
+            not hasattr(act, 'get_contents'):
+        return SCons.Action.Action(act, **kw)
+    return ObjectAction(act, kw)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+'''
+Binary artifact cache
+=====================
+
+After a package is installed its installdir() is packed into a cache
+under a key that captures everything that went into producing it:
+
+* the package name and version,
+* the PLATFORM and the installdir() itself,
+* the source of the wrapper module and its base classes,
+* the stage actions as they will be run and
+* the keys of all the packages it depends on.
+
+A later build (on this or any node sharing the cache directory) that
+computes the same key restores the packed installdir instead of
+downloading and building the package again.
+'''
+
+import os
+import sys
+import shutil
+import tarfile
+import hashlib
+
+from metascons import unpack
+
+stages = ['download','unpack','prepare','build','install']
+
+def wrapper_sources(pobj):
+    '''
+    Return the source code of the modules defining the wrapper's class
+    and all its base classes.
+    '''
+    fnames = []
+    for cls in type(pobj).__mro__:
+        mod = sys.modules.get(cls.__module__)
+        fname = getattr(mod,'__file__',None)
+        if not fname: continue
+        if fname[-4:] in ['.pyc','.pyo']:
+            fname = fname[:-1]
+        if fname not in fnames:
+            fnames.append(fname)
+        continue
+    return ''.join([source_text(fname) for fname in fnames])
+
+_sources = {}
+def source_text(fname):
+    'Return the text of a source file, reading it once per run'
+    try:
+        return _sources[fname]
+    except KeyError:
+        pass
+    text = _sources[fname] = open(fname).read()
+    return text
+
+def action_string(action, env):
+    '''
+    Return a string describing an action as it will be run.  Shell
+    commands are substituted as for their SCons signature, functions
+    are described by name.
+    '''
+    if isinstance(action, (list,tuple)):
+        return '\n'.join([action_string(act, env) for act in action])
+    if isinstance(action, basestring):
+        return env.subst(action, 2) # SUBST_SIG, drops $( $) parts
+    func = getattr(action, 'im_func', action)
+    name = getattr(func, '__name__', None) or type(func).__name__
+    cls = getattr(action, 'im_class', None)
+    if cls:
+        name = cls.__name__ + '.' + name
+    return name
+
+def package_key(pobj, depkeys):
+    '''
+    Return the cache key for the wrapper object pobj given the keys of
+    the packages it depends on.
+    '''
+    env = pobj.env
+    hasher = hashlib.sha256()
+    for what in [pobj.name(), pobj.version(), env['PLATFORM'],
+                 pobj.installdir(), wrapper_sources(pobj)]:
+        hasher.update(what + '\0')
+        continue
+    for stage in stages:
+        action = getattr(pobj, stage + '_action')()
+        hasher.update(stage + ':' + action_string(action, env) + '\0')
+        continue
+    for key in sorted(depkeys):
+        hasher.update(key + '\0')
+        continue
+    return hasher.hexdigest()
+
+class ArtifactCache(object):
+    '''
+    A directory of packed installdirs named by their package keys.
+    '''
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        return
+
+    def path(self, key):
+        'Return the path of the packed installdir for the key'
+        return os.path.join(self.root, key[:2], key + '.tar.gz')
+
+    def has(self, key):
+        return os.path.exists(self.path(key))
+
+    def pack(self, key, installdir):
+        'Pack up installdir under the key'
+        path = self.path(key)
+        pdir = os.path.dirname(path)
+        if not os.path.isdir(pdir):
+            try:
+                os.makedirs(pdir)
+            except OSError:
+                if not os.path.isdir(pdir): raise
+                pass
+            pass
+        tmp = '%s.tmp%d' % (path, os.getpid())
+        tar = tarfile.open(tmp, 'w:gz')
+        try:
+            tar.add(installdir, '.')
+        finally:
+            tar.close()
+        os.rename(tmp, path)
+        return path
+
+    def restore(self, key, installdir):
+        '''
+        Replace installdir by what was packed under the key.  Return
+        the number of bytes written.
+        '''
+        shutil.rmtree(installdir, True)
+        return unpack.unpack(self.path(key), installdir)
+
+    pass
+
+class PackAction(object):
+    '''
+    A SCons function action packing a package's installdir into the
+    cache after the install stage.
+    '''
+    def __init__(self, cache, key, installdir):
+        self.cache = cache
+        self.key = key
+        self.installdir = installdir
+        return
+
+    def __call__(self, target, source, env):
+        self.cache.pack(self.key, self.installdir)
+        return
+
+    def strfunction(self, target, source, env):
+        return 'Packing %s into artifact cache' % self.installdir
+
+    def get_contents(self, target, source, env):
+        return self.key
+
+    pass
+
+class RestoreAction(PackAction):
+    '''
+    A SCons function action restoring a package's installdir from the
+    cache instead of running its download through install stages.
+    '''
+    def __call__(self, target, source, env):
+        self.cache.restore(self.key, self.installdir)
+        return
+
+    def strfunction(self, target, source, env):
+        return 'Restoring %s from artifact cache' % self.installdir
+
+    pass
+
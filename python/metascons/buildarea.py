@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+'''
+Build area lifecycle
+====================
+
+Each package is unpacked and built in its sourcedir(), by default
+BUILD_AREA/NAME-VERSION, and the tree is of no use once the package is
+installed unless it is to be rebuilt.  A BuildArea records, in
+.metascons/buildarea.json under the build area, the size and last use
+of each source tree and which build of the package it holds.
+
+After each successful install the least recently used installed trees
+are removed until those recorded fit the size budget.  Trees still
+being built, or whose build failed, are kept.  A package whose tree was
+removed but whose installation is still that of the same build (same
+build fingerprint and its install manifest present) is not unpacked
+and built again: its remaining stages follow the install manifest, as
+for a package restored from the artifact cache.
+
+If a scratch directory is given (eg, on a local disk or tmpfs) each
+tree is made there before unpacking and the sourcedir becomes a
+symbolic link to it.  The paths of the stage targets do not change so
+they stay consistent: if the scratch area is wiped the targets are
+gone along with the tree and the stages are redone as needed.
+'''
+
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import threading
+
+from metascons.manifest import metadir
+from metascons.confcache import Lock
+from metascons.dedupe import human
+
+def tree_size(path):
+    'Return the bytes of disk used by the files under path'
+    size = 0
+    seen = set()
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen: continue
+            seen.add((st.st_dev, st.st_ino))
+            size += st.st_blocks * 512
+            continue
+        continue
+    return size
+
+def remove_tree(path):
+    'Remove a source tree and, if it is a link, the tree it points to'
+    if os.path.islink(path):
+        real = os.path.realpath(path)
+        os.remove(path)
+        path = real
+        pass
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    return
+
+class BuildArea(object):
+    '''
+    Track the source trees under the build area root, keeping the
+    installed ones within budget bytes (None for no limit) and making
+    new ones in the scratch directory if given.
+    '''
+    def __init__(self, root, budget=None, scratch=None):
+        self.root = root
+        self.budget = budget
+        self.scratch = scratch
+        self.path = os.path.join(root, metadir, 'buildarea.json')
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.lock = threading.Lock()
+        self.busy = set()
+        self.evictions = self.reclaimed = 0
+        atexit.register(self.report)
+        return
+
+    def load(self):
+        try:
+            return json.load(open(self.path))
+        except (IOError, ValueError):
+            return {}
+
+    def save(self, record):
+        tmp = '%s.tmp%d' % (self.path, os.getpid())
+        json.dump(record, open(tmp,'w'), indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+        return
+
+    def update(self, sourcedir, **info):
+        'Update what is recorded of a source tree, return the whole record'
+        with self.lock, Lock(self.path):
+            record = self.load()
+            record.setdefault(sourcedir, {}).update(info)
+            self.save(record)
+        return record
+
+    def place(self, sourcedir):
+        '''
+        Make the tree of sourcedir in the scratch area if it is used and
+        the tree does not yet exist.  This must be done before SCons
+        makes the directories of the stage targets in it.
+        '''
+        if not self.scratch or os.path.isdir(sourcedir): return
+        if os.path.islink(sourcedir):
+            os.remove(sourcedir)        # its scratch tree is gone
+        real = os.path.join(self.scratch, os.path.basename(sourcedir))
+        if os.path.isdir(real):
+            shutil.rmtree(real)         # left from an earlier tree
+        os.makedirs(real)
+        if not os.path.isdir(os.path.dirname(sourcedir)):
+            os.makedirs(os.path.dirname(sourcedir))
+        os.symlink(real, sourcedir)
+        return
+
+    def use(self, sourcedir):
+        'Note that a stage is about to work in sourcedir'
+        with self.lock:
+            self.busy.add(sourcedir)
+        self.update(sourcedir, used=time.time(), state='building')
+        return
+
+    def installed(self, sourcedir, fingerprint, manifest):
+        '''
+        Note that the build in sourcedir with the fingerprint was
+        installed, writing the manifest, then evict trees over budget.
+        '''
+        self.update(sourcedir, used=time.time(), state='installed',
+                    size=tree_size(sourcedir), fingerprint=fingerprint,
+                    manifest=manifest)
+        with self.lock:
+            self.busy.discard(sourcedir)
+        self.evict()
+        return
+
+    def evict(self):
+        '''
+        Remove the least recently used installed trees until the
+        recorded trees fit the budget.  Return the number removed.
+        '''
+        if self.budget is None: return 0
+        count = 0
+        with self.lock, Lock(self.path):
+            record = self.load()
+            live = [(info.get('used',0), path) for path,info in record.iteritems() \
+                        if info.get('state') != 'evicted']
+            total = sum(record[path].get('size',0) for used,path in live)
+            for used,path in sorted(live):
+                if total <= self.budget: break
+                info = record[path]
+                if info.get('state') != 'installed' or path in self.busy: continue
+                remove_tree(path)
+                info['state'] = 'evicted'
+                total -= info.get('size',0)
+                self.reclaimed += info.get('size',0)
+                count += 1
+                continue
+            self.save(record)
+            self.evictions += count
+        return count
+
+    def evicted(self, sourcedir, fingerprint, manifest):
+        '''
+        Return True if the tree of sourcedir is gone but the package is
+        installed from the build with the fingerprint.
+        '''
+        if os.path.isdir(sourcedir): return False
+        info = self.load().get(sourcedir)
+        if not info or info.get('fingerprint') != fingerprint: return False
+        return info.get('manifest') == manifest and os.path.exists(manifest)
+
+    def report(self, out=sys.stdout):
+        'Print the size of the build area and what was evicted'
+        if self.budget is None: return
+        record = self.load()
+        live = [info for info in record.itervalues() if info.get('state') != 'evicted']
+        out.write('\nbuild area: %d trees, %s of %s' % \
+                      (len(live), human(sum(info.get('size',0) for info in live)),
+                       human(self.budget)))
+        if self.evictions:
+            out.write(', %d evicted reclaiming %s' % (self.evictions, human(self.reclaimed)))
+        out.write('\n')
+        return
+
+    pass
+
+class BuildAreaAction(object):
+    '''
+    A SCons function action calling a BuildArea method with the given
+    arguments around a stage.  It does not change the stage's signature.
+    '''
+    def __init__(self, area, method, *args):
+        self.area = area
+        self.method = method
+        self.args = args
+        return
+
+    def __call__(self, target, source, env):
+        getattr(self.area, self.method)(*self.args)
+        return
+
+    def strfunction(self, target, source, env):
+        return None
+
+    def get_contents(self, target, source, env):
+        return ''
+
+    pass
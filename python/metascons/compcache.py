@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+'''
+Compiler cache
+==============
+
+If a compiler cache directory is given, each package's ENV gets CC
+and CXX set to small scripts that run this module in front of the real
+C and C++ compilers.  Builds that honor CC and CXX, such as autoconf
+ones, then go through it.
+
+For a command that compiles one source file to an object (ie, has -c
+and no -E, -S or similar) the source is first preprocessed.  The
+digest of the compiler, the arguments and the preprocessed text names
+an entry in the cache.  If the entry exists its object file (and any
+dependency file requested with -MD/-MMD) is copied out instead of
+compiling.  Otherwise the compiler runs and what it produced is
+stored.  As a dependency file names the object, or the targets given
+with -MT/-MQ, those are part of the digest when one is made.
+Anything else is passed straight to the compiler.
+
+Cache entries are files under the cache directory.  Using an entry
+updates its time, and trim() removes the least recently used entries
+until the cache fits its size limit.
+
+Each compile records whether it hit and how long compiling took (or,
+for a hit, took when the entry was made) in a file named after the
+package.  report() summarizes these at the end of the build.
+
+usage: python compcache.py COMPILER [ARGS ...]
+'''
+
+import os
+import sys
+import time
+import atexit
+import errno
+import shutil
+import hashlib
+import subprocess
+
+sources = ['.c','.cc','.cp','.cpp','.cxx','.c++','.C','.m','.mm']
+
+# options whose next argument is a separate word
+with_value = ['-o','-MF','-MT','-MQ','-I','-D','-U','-include','-imacros',
+              '-isystem','-idirafter','-iprefix','-iquote','-x','-arch',
+              '-Xpreprocessor','-Xassembler','-Xlinker','-aux-info']
+
+# options that mean the output is not just an object file
+uncacheable = ['-E','-S','-M','-MM','-fsyntax-only','-save-temps','-']
+
+def parse(args):
+    '''
+    Return (source, object, depfile, dependency targets, preprocess
+    args) for a cacheable compile command or None.  The dependency
+    targets are the -MT/-MQ options and values or else the object.
+    '''
+    if '-c' not in args: return None
+    source = obj = depfile = None
+    makedeps = False
+    deptargets = []
+    cpp = []
+    ind = 0
+    while ind < len(args):
+        arg = args[ind]
+        val = None
+        if arg in with_value:
+            if ind + 1 >= len(args): return None
+            val = args[ind+1]
+            ind += 1
+            pass
+        ind += 1
+        if arg in uncacheable or arg.startswith('-save-temps'):
+            return None
+        if arg == '-o':
+            obj = val
+            continue
+        if arg in ['-MD','-MMD']:
+            makedeps = True
+            continue
+        if arg == '-MF':
+            depfile = val
+            continue
+        if arg in ['-MT','-MQ']:
+            deptargets += [arg, val]
+            continue
+        if arg in ['-MP','-c']:
+            continue
+        if not arg.startswith('-') and val is None:
+            if os.path.splitext(arg)[1] not in sources: return None
+            if source: return None # more than one
+            source = arg
+            continue
+        cpp.append(arg)
+        if val is not None:
+            cpp.append(val)
+        continue
+    if not source: return None
+    if not obj:
+        obj = os.path.splitext(os.path.basename(source))[0] + '.o'
+    if makedeps and not depfile:
+        depfile = os.path.splitext(obj)[0] + '.d'
+    if not makedeps:
+        depfile = None
+    return source, obj, depfile, deptargets or [obj], cpp
+
+def compiler_id(compiler):
+    'Return a string identifying the compiler executable'
+    path = compiler
+    if not os.path.isabs(path):
+        for pdir in os.environ.get('PATH','').split(':'):
+            cand = os.path.join(pdir, compiler)
+            if os.path.isfile(cand) and os.access(cand, os.X_OK):
+                path = cand
+                break
+            continue
+        pass
+    path = os.path.realpath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path
+    return '%s %d %d' % (path, st.st_size, int(st.st_mtime))
+
+def atomic_copy(src, dst):
+    'Copy src to dst so dst never holds a partial file'
+    tmp = '%s.tmp%d' % (dst, os.getpid())
+    shutil.copyfile(src, tmp)
+    os.rename(tmp, dst)
+    return
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, err:
+        if err.errno != errno.EEXIST: raise
+    return
+
+class CompilerCache(object):
+    '''
+    A directory of cached compiler outputs.
+    '''
+    def __init__(self, root, limit=None):
+        self.root = os.path.abspath(root)
+        self.limit = limit
+        self.build = None
+        return
+
+    def start(self, compilers):
+        '''
+        Begin a build using the given compilers (see setup()).  Return
+        the ENV entries that send compiles through the cache.  At exit
+        the statistics are reported and the cache trimmed.
+        '''
+        self.build = '%d.%d' % (os.getpid(), int(time.time()))
+        ret = self.setup(compilers)
+        ret['METASCONS_COMPILER_CACHE'] = self.root
+        ret['METASCONS_BUILD'] = self.build
+        atexit.register(self.finish)
+        return ret
+
+    def finish(self):
+        'Called at exit to report on the build and trim the cache'
+        self.report(self.build)
+        self.trim()
+        return
+
+    def entry(self, key):
+        return os.path.join(self.root, 'objects', key[:2], key)
+
+    def stats_dir(self, build):
+        return os.path.join(self.root, 'stats', build)
+
+    def lookup(self, key, obj, depfile):
+        '''
+        Copy out the cached outputs for key and return the compile time
+        stored with them or None if there is no such entry.
+        '''
+        entry = self.entry(key)
+        try:
+            spent = float(open(entry + '.time').read())
+            atomic_copy(entry + '.o', obj)
+            if depfile:
+                atomic_copy(entry + '.d', depfile)
+        except (IOError, OSError, ValueError):
+            return None
+        now = time.time()
+        for ext in ['.o','.time']:
+            try:
+                os.utime(entry + ext, (now, now))
+            except OSError:
+                pass
+            continue
+        return spent
+
+    def store(self, key, obj, depfile, spent):
+        'Store the outputs of a compile that took spent seconds'
+        entry = self.entry(key)
+        makedirs(os.path.dirname(entry))
+        atomic_copy(obj, entry + '.o')
+        if depfile:
+            atomic_copy(depfile, entry + '.d')
+        tmp = '%s.time.tmp%d' % (entry, os.getpid())
+        open(tmp,'w').write('%f\n' % spent)
+        os.rename(tmp, entry + '.time') # written last, marks entry complete
+        return
+
+    def compile(self, compiler, args, package=None, build=None):
+        'Run the compiler with args, using the cache if possible'
+        parsed = parse(args)
+        if not parsed:
+            return subprocess.call([compiler] + args)
+        source, obj, depfile, deptargets, cpp = parsed
+
+        proc = subprocess.Popen([compiler] + cpp + ['-E', source],
+                                stdout=subprocess.PIPE)
+        text = proc.communicate()[0]
+        if proc.returncode:
+            return subprocess.call([compiler] + args) # let it report errors
+
+        hasher = hashlib.sha1()
+        for part in [compiler_id(compiler), '\0'.join(cpp),
+                     depfile and 'deps\0' + '\0'.join(deptargets) or '', text]:
+            hasher.update(part + '\0')
+            continue
+        key = hasher.hexdigest()
+
+        spent = self.lookup(key, obj, depfile)
+        if spent is not None:
+            self.record(package, build, 'hit', spent)
+            return 0
+
+        start = time.time()
+        status = subprocess.call([compiler] + args)
+        spent = time.time() - start
+        if status == 0 and os.path.exists(obj):
+            try:
+                self.store(key, obj, depfile, spent)
+            except (IOError, OSError):
+                pass            # eg, cache full, just go on
+            pass
+        self.record(package, build, 'miss', spent)
+        return status
+
+    def record(self, package, build, what, spent):
+        'Append the outcome of a compile to the package statistics'
+        if not package or not build: return
+        sdir = self.stats_dir(build)
+        makedirs(sdir)
+        fd = os.open(os.path.join(sdir, package),
+                     os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+        os.write(fd, '%s %f\n' % (what, spent))
+        os.close(fd)
+        return
+
+    def setup(self, ccs, python=sys.executable):
+        '''
+        Write wrapper scripts in front of the compilers given as a
+        dictionary mapping a variable name (eg, CC) to a compiler path.
+        Return a dictionary mapping the same names to the wrappers.
+        '''
+        bindir = os.path.join(self.root, 'bin')
+        makedirs(bindir)
+        me = os.path.abspath(__file__)
+        if me[-4:] in ['.pyc','.pyo']:
+            me = me[:-1]
+        ret = {}
+        for var,compiler in ccs.iteritems():
+            path = os.path.join(bindir, '%s-%s' % \
+                                    (var.lower(), os.path.basename(compiler)))
+            text = '#!/bin/sh\nexec %s %s %s "$@"\n' % (python, me, compiler)
+            if not os.path.exists(path) or open(path).read() != text:
+                tmp = '%s.tmp%d' % (path, os.getpid())
+                open(tmp,'w').write(text)
+                os.chmod(tmp, 0755)
+                os.rename(tmp, path)
+                pass
+            ret[var] = path
+            continue
+        return ret
+
+    def trim(self, limit=None):
+        '''
+        Remove the least recently used entries until the cache is no
+        bigger than limit bytes.  Return the number removed.
+        '''
+        limit = limit or self.limit
+        if not limit: return 0
+        entries = {}
+        total = 0
+        objdir = os.path.join(self.root, 'objects')
+        for dirpath, dirnames, filenames in os.walk(objdir):
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                base = os.path.splitext(path)[0]
+                used, size = entries.get(base, (0, 0))
+                entries[base] = (max(used, st.st_mtime), size + st.st_size)
+                total += st.st_size
+                continue
+            continue
+        removed = 0
+        for base,(used,size) in sorted(entries.items(), key=lambda e: e[1][0]):
+            if total <= limit: break
+            for ext in ['.time','.o','.d']:
+                try:
+                    os.remove(base + ext)
+                except OSError:
+                    pass
+                continue
+            total -= size
+            removed += 1
+            continue
+        return removed
+
+    def report(self, build, out=sys.stdout):
+        '''
+        Print the hits and time saved per package during the build and
+        forget them.
+        '''
+        if not build: return
+        sdir = self.stats_dir(build)
+        if not os.path.isdir(sdir): return
+        rows = []
+        for package in sorted(os.listdir(sdir)):
+            hits = misses = 0
+            saved = 0.0
+            for line in open(os.path.join(sdir, package)):
+                what, spent = line.split()
+                if what == 'hit':
+                    hits += 1
+                    saved += float(spent)
+                else:
+                    misses += 1
+                continue
+            rows.append((package, hits, misses, saved))
+            continue
+        shutil.rmtree(sdir, True)
+        if not rows: return
+        fmt = '%-20s %9s %9s %9s %10s\n'
+        out.write('\ncompiler cache:\n')
+        out.write(fmt % ('package','compiles','hits','hit rate','saved(s)'))
+        for package, hits, misses, saved in rows:
+            out.write(fmt % (package, hits + misses, hits,
+                             '%.0f%%' % (100.0 * hits / (hits + misses)),
+                             '%.1f' % saved))
+            continue
+        return
+
+    pass
+
+def parse_size(text):
+    'Return the bytes in a size like "500M" or "5G"'
+    text = str(text).strip()
+    units = {'K': 1<<10, 'M': 1<<20, 'G': 1<<30, 'T': 1<<40}
+    if text and text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+def main(argv):
+    if not argv:
+        sys.stderr.write(__doc__.split('usage: ')[-1])
+        return 1
+    root = os.environ.get('METASCONS_COMPILER_CACHE')
+    if not root:
+        return subprocess.call(argv)
+    cache = CompilerCache(root)
+    return cache.compile(argv[0], argv[1:],
+                         os.environ.get('METASCONS_PACKAGE'),
+                         os.environ.get('METASCONS_BUILD'))
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''
+Shared configure cache
+======================
+
+Packages built with autoconf probe for much the same headers, types
+and functions.  AutoconfWrapper runs configure through this module so
+that what one package found out is given to the next one built for the
+same platform:
+
+* under a lock, the variables of the shared cache file are copied to
+  a private cache file in the package's ".metascons" directory,
+
+* configure runs with --cache-file pointing at the private file and
+
+* if it succeeds, under the lock again, the variables it wrote are
+  merged into the shared file.
+
+Concurrent configures thus only wait for each other while copying and
+merging.  Variables recording the precious environment (ac_cv_env_*),
+and those whose value names the package's own directory, are never
+shared.  A package may also name variables (glob patterns) to drop:
+these are not given to it, so it probes for them itself, and are not
+merged back.  Removing the shared file invalidates all results.
+
+usage: python confcache.py SHARED [-d PATTERN ...] -- CONFIGURE [ARGS ...]
+'''
+
+import os
+import re
+import sys
+import fcntl
+import fnmatch
+import optparse
+import subprocess
+
+# lines are either "var=${var=value}" or 'test "${var+set}" = set || var=value'
+cache_line = re.compile(r'^(?:test "\$\{(\w+)\+set\}" = set \|\| )?(\w+)=')
+
+header = '''\
+# This is a configure cache shared by the packages of a metascons
+# suite, see metascons.confcache.  Remove it to probe everything again.
+'''
+
+def parse(text):
+    'Return a dictionary mapping cache variables to their cache lines'
+    ret = {}
+    for line in text.split('\n'):
+        match = cache_line.match(line)
+        if not match: continue
+        ret[match.group(2)] = line
+        continue
+    return ret
+
+def read(path):
+    'Return the variables of the cache file or an empty dictionary'
+    try:
+        return parse(open(path).read())
+    except IOError:
+        return {}
+
+def write(path, cache):
+    'Write the cache variables to the file atomically'
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    fp = open(tmp, 'w')
+    fp.write(header)
+    for var in sorted(cache):
+        fp.write(cache[var] + '\n')
+        continue
+    fp.close()
+    os.rename(tmp, path)
+    return
+
+def shareable(var, line, drop=(), private_dirs=()):
+    'Return True if the cache variable may be shared with other packages'
+    if var.startswith('ac_cv_env_'): return False
+    for pat in drop:
+        if fnmatch.fnmatchcase(var, pat): return False
+        continue
+    for pdir in private_dirs:
+        if pdir in line: return False
+        continue
+    return True
+
+class Lock(object):
+    'An exclusive lock on a file next to the given one'
+    def __init__(self, path):
+        self.path = path + '.lock'
+        return
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR|os.O_CREAT, 0644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        return False
+    pass
+
+def fetch(shared, private, drop=()):
+    '''
+    Write the shareable variables of the shared cache to the private
+    one.  Return their number.
+    '''
+    with Lock(shared):
+        cache = read(shared)
+    cache = dict([(var,line) for var,line in cache.iteritems() \
+                      if shareable(var, line, drop)])
+    write(private, cache)
+    return len(cache)
+
+def merge(shared, private, drop=(), private_dirs=()):
+    '''
+    Add the shareable variables of the private cache to the shared
+    one.  Return the number of new or changed ones.
+    '''
+    mine = read(private)
+    changed = 0
+    with Lock(shared):
+        cache = read(shared)
+        for var,line in mine.iteritems():
+            if not shareable(var, line, drop, private_dirs): continue
+            if cache.get(var) == line: continue
+            cache[var] = line
+            changed += 1
+            continue
+        if changed:
+            write(shared, cache)
+    return changed
+
+def configure(shared, command, drop=(), cwd='.'):
+    '''
+    Run the configure command in cwd through the shared cache and
+    return its exit status.
+    '''
+    cwd = os.path.abspath(cwd)
+    pdir = os.path.join(cwd, '.metascons')
+    if not os.path.isdir(pdir):
+        os.makedirs(pdir)
+    private = os.path.join(pdir, 'config.cache')
+    sdir = os.path.dirname(os.path.abspath(shared))
+    if not os.path.isdir(sdir):
+        os.makedirs(sdir)
+
+    fetch(shared, private, drop)
+    status = subprocess.call(command + ['--cache-file=%s' % private], cwd=cwd)
+    if status == 0:
+        merge(shared, private, drop, [cwd, os.path.realpath(cwd)])
+    return status
+
+def command(shared, drop=(), python=sys.executable):
+    'Return the shell words to put in front of a configure command'
+    me = os.path.abspath(__file__)
+    if me[-4:] in ['.pyc','.pyo']:
+        me = me[:-1]
+    words = [python, me, shared]
+    for pat in drop:
+        words += ['-d', "'%s'" % pat]
+    return ' '.join(words + ['--'])
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.split('usage: ')[-1].strip())
+    parser.add_option('-d','--drop', default=[], action='append',
+                      help='Pattern of cache variables not to share, may repeat')
+    opts, args = parser.parse_args(argv)
+    if len(args) < 2:
+        parser.error('Need the shared cache file and the configure command')
+    return configure(args[0], args[1:], opts.drop)
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+'''
+Build daemon
+============
+
+Run with --daemon=SOCKET, metascons reads the configuration, imports
+the wrappers and sets up the stage graph as usual but then, instead of
+building, keeps all that in memory and answers requests on a Unix
+socket:
+
+status
+
+  the stages that are out of date, and so those after them, found by
+  asking the SCons nodes of the stage targets whether they are up to
+  date,
+
+plan
+
+  the build plan from the stage history (see metascons.plan) and
+
+build
+
+  run scons, with the daemon's own arguments plus any given, and
+  stream its output back.  Builds run one at a time.
+
+Only status and plan are answered from the graph in memory.  A build
+is a new scons process which reads the configuration, imports the
+wrappers and sets up the graph again; the daemon just saves typing
+its arguments and throws its cached node state away afterwards.
+
+The files the graph was made from (the configuration and recipe files
+and the wrapper modules) and the stage targets are watched, with
+inotify where available and by polling their status otherwise.  If
+the former change the daemon starts itself again to read them.  If
+the latter change the cached node state is thrown away and the status
+recomputed on the next request, which is otherwise answered at once.
+
+The protocol is that of metascons.dispatch: JSON objects, one per
+line, with an "op" key.  The client in this module is
+
+  python daemon.py SOCKET status|plan|stop
+  python daemon.py SOCKET build [SCONS ARGS ...]
+
+Status exits with 1 if something is out of date.
+'''
+
+import os
+import sys
+import time
+import errno
+import select
+import socket
+import threading
+import subprocess
+import SocketServer
+from StringIO import StringIO
+
+from metascons.dispatch import send, receive
+
+def stamp(path):
+    'Return what tells if a file changed'
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+def inotify_functions():
+    '''
+    Return the libc inotify_init1 and inotify_add_watch functions or
+    None if not available (it is Linux only).
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return libc.inotify_init1, libc.inotify_add_watch
+    except (ImportError, OSError, AttributeError):
+        return None
+
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_NONBLOCK, IN_CLOEXEC = 04000, 02000000
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+class Watcher(object):
+    '''
+    Tell which of a set of files changed.  Their directories are
+    watched with inotify, if possible, to wake up wait() early.
+    Directories that do not exist yet are tried again later.
+    '''
+    def __init__(self, paths):
+        self.stamps = dict([(path, stamp(path)) for path in paths])
+        self.fd = None
+        self.watched = set()
+        funcs = inotify_functions()
+        if funcs:
+            init, self.add_watch = funcs
+            fd = init(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+            pass
+        self.watch()
+        return
+
+    def watch(self):
+        'Watch the directories of the files not yet watched'
+        if self.fd is None: return
+        for dirname in set(map(os.path.dirname, self.stamps)) - self.watched:
+            if self.add_watch(self.fd, dirname, watch_mask) >= 0:
+                self.watched.add(dirname)
+            continue
+        return
+
+    def drain(self):
+        'Read away pending inotify events'
+        while True:
+            try:
+                if not os.read(self.fd, 1<<16): break
+            except OSError, err:
+                if err.errno in [errno.EAGAIN, errno.EWOULDBLOCK]: break
+                raise
+            continue
+        return
+
+    def wait(self, timeout):
+        '''
+        Wait up to timeout seconds for a change and return the list of
+        the files that changed.
+        '''
+        if self.fd is None:
+            time.sleep(timeout)
+        elif select.select([self.fd],[],[],timeout)[0]:
+            self.drain()
+        return self.changed()
+
+    def changed(self):
+        'Return the list of files changed since last asked'
+        ret = []
+        for path, old in self.stamps.items():
+            new = stamp(path)
+            if new != old:
+                self.stamps[path] = new
+                ret.append(path)
+            continue
+        self.watch()
+        return ret
+
+    pass
+
+class Graph(object):
+    '''
+    The stage graph of a MetaSCons object, telling which stages are
+    out of date.  A stage is if a target of it is or any stage before
+    it is.
+    '''
+    def __init__(self, msc):
+        self.msc = msc
+        self.lock = threading.Lock()
+        self.stale = None       # None until computed
+        nodes = set()
+        for stages in msc.stage_nodes.itervalues():
+            for stage, targets in stages:
+                for node in targets:
+                    nodes.add(node)
+                    nodes.update(node.all_children(scan=0))
+                    continue
+                continue
+            continue
+        self.nodes = list(nodes)
+        return
+
+    def paths(self):
+        'Return the paths of the stage targets'
+        return [str(node.abspath) for stages in self.msc.stage_nodes.itervalues() \
+                    for stage, targets in stages for node in targets]
+
+    def invalidate(self):
+        with self.lock:
+            self.stale = None
+        return
+
+    def refresh(self):
+        'Forget what SCons knows of the nodes and their signatures'
+        import SCons.SConsign
+        SCons.SConsign.Reset()
+        SCons.SConsign.DataBase.clear()
+        for node in self.nodes:
+            node.clear()
+            node.clear_memoized_values()
+            parent = getattr(node, 'dir', None)
+            if parent is not None:
+                parent._sconsign = None
+                parent.clear_memoized_values()
+            continue
+        return
+
+    def status(self):
+        '''
+        Return a dictionary of each package with stages out of date to
+        their list.
+        '''
+        with self.lock:
+            if self.stale is None:
+                self.stale = self.compute()
+            return self.stale
+
+    def compute(self):
+        self.refresh()
+        plan = self.msc.make_plan()
+        targets = dict([((pname, stage), nodes) for pname, stages \
+                            in self.msc.stage_nodes.iteritems() \
+                            for stage, nodes in stages])
+        stale = set()
+        for node in plan.order():
+            if [pred for pred in plan.preds[node] if pred in stale]:
+                stale.add(node)
+                continue
+            for target in targets.get(node, []):
+                target.scan()
+                if not target.is_up_to_date():
+                    stale.add(node)
+                    break
+                continue
+            continue
+        ret = {}
+        for pname, stages in self.msc.chains.iteritems():
+            late = [stage for stage in stages if (pname, stage) in stale]
+            if late:
+                ret[pname] = late
+            continue
+        return ret
+
+    pass
+
+class Handler(SocketServer.StreamRequestHandler):
+    'Serve one client request'
+
+    def handle(self):
+        try:
+            msg, payload = receive(self.rfile)
+        except (EOFError, ValueError):
+            return
+        op = msg.get('op')
+        daemon = self.server.daemon
+        if op == 'status':
+            start = time.time()
+            stale = daemon.graph.status()
+            send(self.wfile, {'op': 'status', 'stale': stale,
+                              'packages': len(daemon.msc.chains),
+                              'seconds': time.time() - start})
+        elif op == 'plan':
+            out = StringIO()
+            daemon.msc.make_plan().report(msg.get('jobs') or 1, out)
+            send(self.wfile, {'op': 'plan', 'text': out.getvalue()})
+        elif op == 'build':
+            status = daemon.build(msg.get('args', []), self.wfile)
+            send(self.wfile, {'op': 'result', 'status': status})
+        elif op == 'stop':
+            send(self.wfile, {'op': 'result', 'status': 0})
+            daemon.stop = True
+        else:
+            send(self.wfile, {'op': 'error', 'text': 'unknown request "%s"' % op})
+        return
+
+    pass
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class Daemon(object):
+    '''
+    Serve requests about the build set up by the MetaSCons object on
+    the Unix socket at path.  The command is what started this process
+    with daemon_args the arguments that made it a daemon.
+    '''
+    def __init__(self, msc, path, command, daemon_args):
+        self.msc = msc
+        self.path = os.path.abspath(path)
+        self.command = command
+        self.build_command = [sys.executable] + \
+            [arg for arg in command if arg not in daemon_args]
+        self.cwd = os.getcwd()
+        self.graph = Graph(msc)
+        self.sources = set(msc.source_files())
+        self.watcher = Watcher(list(self.sources) + self.graph.paths())
+        self.build_lock = threading.Lock()
+        self.stop = False
+        return
+
+    def build(self, args, out):
+        '''
+        Run scons with args in a new process, which sets the graph up
+        again, sending its output.  Return its status.
+        '''
+        with self.build_lock:
+            proc = subprocess.Popen(self.build_command + args, cwd=self.cwd,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            for line in iter(proc.stdout.readline, ''):
+                send(out, {'op': 'log', 'text': line})
+                continue
+            status = proc.wait()
+        self.graph.invalidate()
+        return status
+
+    def serve(self):
+        '''
+        Answer requests until stopped.  Start again if the files the
+        graph was made from change.
+        '''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = Server(self.path, Handler)
+        server.daemon = self
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print 'metascons daemon serving %d packages on %s' % \
+            (len(self.msc.chains), self.path)
+        sys.stdout.flush()
+        try:
+            while not self.stop:
+                changed = self.watcher.wait(1.0)
+                if not changed: continue
+                self.graph.invalidate()
+                if not self.sources.intersection(changed): continue
+                with self.build_lock:
+                    print 'metascons daemon reloading for', ' '.join(sorted(
+                            self.sources.intersection(changed)))
+                    sys.stdout.flush()
+                    server.server_close()
+                    os.remove(self.path)
+                    os.execv(sys.executable, [sys.executable] + self.command)
+                continue
+        finally:
+            server.shutdown()
+            server.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        return
+
+    pass
+
+def request(path, msg, out=sys.stdout, wait=5.0):
+    '''
+    Send a request to the daemon at path, printing any output.  Return
+    the reply.  A daemon starting again is waited for.
+    '''
+    deadline = time.time() + wait
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            break
+        except socket.error, err:
+            sock.close()
+            if err.errno not in [errno.ENOENT, errno.ECONNREFUSED] or \
+                    time.time() > deadline:
+                raise
+            time.sleep(0.1)
+        continue
+    fp = sock.makefile('rwb')
+    send(fp, msg)
+    try:
+        while True:
+            reply, payload = receive(fp)
+            if reply['op'] != 'log':
+                return reply
+            out.write(reply['text'])
+            out.flush()
+            continue
+    finally:
+        fp.close()
+        sock.close()
+
+def main(argv):
+    usage = 'usage: python daemon.py SOCKET status|plan [JOBS]|stop|build [ARGS ...]\n'
+    if len(argv) < 2 or argv[1] not in ['status','plan','build','stop']:
+        sys.stderr.write(usage)
+        return 2
+    path, op = argv[:2]
+    msg = {'op': op}
+    if op == 'build':
+        msg['args'] = argv[2:]
+    if op == 'plan' and argv[2:]:
+        msg['jobs'] = int(argv[2])
+    reply = request(path, msg)
+    if reply['op'] == 'error':
+        sys.stderr.write(reply['text'] + '\n')
+        return 2
+    if op == 'status':
+        stale = reply['stale']
+        for pname in sorted(stale):
+            print '%s: %s' % (pname, ' '.join(stale[pname]))
+            continue
+        print '%d of %d packages out of date (%.3f s)' % \
+            (len(stale), reply['packages'], reply['seconds'])
+        return stale and 1 or 0
+    if op == 'plan':
+        sys.stdout.write(reply['text'])
+        return 0
+    return reply['status']
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+'''
+Install area deduplication
+==========================
+
+Installs of several versions and platform variants of a package hold
+many identical files.  If an install store is given, after each
+install stage the files of the installdir() are hashed, in parallel,
+and each is replaced by a hard link to the copy of its content in a
+content-addressed store (see metascons.store), adding it there first
+if it is new.  Identical files in any number of installs then take
+space once.
+
+What was linked is recorded in .metascons/dedupe.json in the install
+directory so unchanged files are not hashed again.  Before the
+install stage is redone the recorded files that are still links are
+replaced by private copies so the install can not write through a
+link into the store and every other install sharing the file.
+
+Only regular, non-empty files are linked and only to stored copies
+with the same permissions, as links share them.  Nothing is linked if
+the store is on another file system.
+
+A store file whose link count has dropped to one is used by no install
+anymore: gc() removes these.  Run
+
+  python dedupe.py gc STORE
+
+after removing installs and
+
+  python dedupe.py link STORE INSTALLDIR ...
+
+to deduplicate installs made before the store was used.
+'''
+
+import os
+import sys
+import json
+import stat
+import atexit
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
+
+from metascons.store import ContentStore, file_digest
+from metascons.manifest import metadir
+
+def record_path(installdir):
+    return os.path.join(installdir, metadir, 'dedupe.json')
+
+def load_record(installdir):
+    'Return the record of linked files of the install directory'
+    try:
+        return json.load(open(record_path(installdir)))
+    except (IOError, ValueError):
+        return {}
+
+def save_record(installdir, record):
+    path = record_path(installdir)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = path + '.tmp'
+    json.dump(record, open(tmp, 'w'))
+    os.rename(tmp, path)
+    return
+
+def candidates(installdir):
+    'Return a list of (relative path, stat) of the files that may be linked'
+    ret = []
+    for dirpath, dirnames, filenames in os.walk(installdir):
+        if dirpath == installdir and metadir in dirnames:
+            dirnames.remove(metadir)
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode) or not st.st_size: continue
+            ret.append((os.path.relpath(path, installdir), st))
+            continue
+        continue
+    return ret
+
+def hash_files(paths, threads):
+    'Return the digests of the files, hashing threads at a time'
+    if threads <= 1 or len(paths) < 2:
+        return map(file_digest, paths)
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(file_digest, paths, chunksize=8)
+    finally:
+        pool.close()
+
+def private_copy(path):
+    'Replace a hard linked file by a copy of its own'
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    shutil.copy2(path, tmp)
+    os.rename(tmp, path)
+    return
+
+class Deduper(object):
+    '''
+    Link the files of install directories into a ContentStore at root,
+    hashing with threads threads.  Totals are kept for a report.
+    '''
+    def __init__(self, root, threads=4):
+        self.store = ContentStore(root)
+        if not os.path.isdir(self.store.root):
+            os.makedirs(self.store.root)
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.linked = self.files = self.reclaimed = 0
+        atexit.register(self.report)
+        return
+
+    def link(self, installdir):
+        '''
+        Replace the files of installdir by links into the store.
+        Return the number of files linked now and the bytes this saved.
+        '''
+        if os.stat(installdir).st_dev != os.stat(self.store.root).st_dev:
+            return 0, 0
+        record = load_record(installdir)
+        files = candidates(installdir)
+        todo = []
+        for rel,st in files:
+            old = record.get(rel)
+            if old and old[1:] == [st.st_ino, st.st_size, st.st_mtime]:
+                continue        # still the linked file
+            todo.append((rel, st))
+            continue
+        digests = hash_files([os.path.join(installdir, rel) for rel,st in todo],
+                             self.threads)
+        linked = saved = 0
+        for (rel,st),digest in zip(todo, digests):
+            path = os.path.join(installdir, rel)
+            spath = self.store.path(digest)
+            try:
+                sst = os.stat(spath)
+            except OSError:
+                sst = None
+            if sst and stat.S_IMODE(sst.st_mode) != stat.S_IMODE(st.st_mode):
+                continue        # a link would change its permissions
+            if sst and sst.st_ino == st.st_ino:
+                pass            # already linked
+            else:
+                if sst and st.st_nlink == 1:
+                    saved += st.st_size
+                self.store.add(path, digest)
+                linked += 1
+                pass
+            nst = os.lstat(path)
+            record[rel] = [digest, nst.st_ino, nst.st_size, nst.st_mtime]
+            continue
+        known = set(rel for rel,st in files)
+        for rel in record.keys():
+            if rel not in known:
+                del record[rel]
+            continue
+        save_record(installdir, record)
+        with self.lock:
+            self.files += len(files)
+            self.linked += linked
+            self.reclaimed += saved
+        return linked, saved
+
+    def unshare(self, installdir):
+        '''
+        Give each recorded file of installdir that is still a link a
+        copy of its own.  Return the number copied.
+        '''
+        count = 0
+        for rel,info in load_record(installdir).iteritems():
+            path = os.path.join(installdir, rel)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if st.st_nlink > 1 and st.st_ino == info[1]:
+                private_copy(path)
+                count += 1
+            continue
+        return count
+
+    def report(self, out=sys.stdout):
+        'Print what was linked and the space reclaimed'
+        if not self.files: return
+        out.write('\ninstall store: %d of %d files linked, %s reclaimed\n' % \
+                      (self.linked, self.files, human(self.reclaimed)))
+        return
+
+    pass
+
+def gc(root):
+    '''
+    Remove the store files no install links to any more.  Return the
+    number of files and bytes removed.
+    '''
+    count = size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            st = os.lstat(path)
+            if st.st_nlink > 1: continue
+            os.remove(path)
+            count += 1
+            size += st.st_size
+            continue
+        continue
+    return count, size
+
+def human(nbytes):
+    'Return a byte count in human terms'
+    for unit in ['B','kB','MB','GB','TB']:
+        if nbytes < 1024 or unit == 'TB': break
+        nbytes /= 1024.0
+        continue
+    if unit == 'B':
+        return '%d B' % nbytes
+    return '%.1f %s' % (nbytes, unit)
+
+class DedupeAction(object):
+    '''
+    A SCons function action linking an installdir into the store after
+    the install stage.  It does not change the stage's signature.
+    '''
+    def __init__(self, deduper, installdir):
+        self.deduper = deduper
+        self.installdir = installdir
+        return
+
+    def __call__(self, target, source, env):
+        linked, saved = self.deduper.link(self.installdir)
+        if linked:
+            print 'Linked %d files of %s into install store, %s reclaimed' % \
+                (linked, self.installdir, human(saved))
+        return
+
+    def strfunction(self, target, source, env):
+        return None
+
+    def get_contents(self, target, source, env):
+        return ''
+
+    pass
+
+class UnshareAction(DedupeAction):
+    '''
+    A SCons function action giving the linked files of an installdir
+    copies of their own before the install stage is redone.
+    '''
+    def __call__(self, target, source, env):
+        if os.path.isdir(self.installdir):
+            self.deduper.unshare(self.installdir)
+        return
+
+    pass
+
+def main(argv):
+    usage = 'usage: python dedupe.py gc STORE | link STORE INSTALLDIR ...\n'
+    if len(argv) < 2 or argv[0] not in ['gc','link']:
+        sys.stderr.write(usage)
+        return 1
+    if argv[0] == 'gc':
+        count, size = gc(argv[1])
+        print 'Removed %d unused files, %s' % (count, human(size))
+        return 0
+    deduper = Deduper(argv[1])
+    for installdir in argv[2:]:
+        linked, saved = deduper.link(installdir)
+        print '%s: %d files linked, %s reclaimed' % (installdir, linked, human(saved))
+        continue
+    return 0
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
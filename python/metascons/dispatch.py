@@ -0,0 +1,716 @@
+#!/usr/bin/env python
+'''
+Dispatching package builds to workers
+=====================================
+
+With a dispatcher the prepare, build and install stages of a package
+are not run by SCons itself but sent, as one chain, to a worker
+process which may be on another node.  The first of these stages
+that SCons finds out of date sends the chain to the least busy
+worker; the later stages then just report how their part went.
+Packages whose stage actions are not all command strings are built
+locally as usual.
+
+Unless the workers see the same file system (shared mode) the
+package's unpacked source directory and the install directories of
+all the packages it depends on are shipped to the worker along with
+the chain, each only if the worker does not already have the copy
+described by its manifest (see metascons.manifest).  The output of
+the commands is streamed back as it is made and the stage target
+files and the install directory are sent back as each stage ends.
+In shared mode each stage is sent on its own and nothing is shipped.
+
+Workers are started with
+
+  METASCONS_DISPATCH_TOKEN=SECRET \
+    python dispatch.py worker --listen HOST:PORT [--slots N]
+
+and listen on a TCP port (by default 127.0.0.1:7777) or, if the
+address has a "/", a Unix socket.  As a worker runs any command it is
+sent, it only serves clients giving the same secret token, which
+metascons takes from METASCONS_DISPATCH_TOKEN too.  The tar files a
+worker or metascons unpacks may only hold the paths shipped or fetched
+and no links leading outside of them.
+
+A local pool of worker processes, one per slot, may be used instead
+("local:N").  Unless in shared mode each of these works under a
+private root directory which all paths are moved below so shipping
+is exercised on a single machine.  Note that any path an install
+records is then that below the root.
+
+The protocol is JSON objects, one per line, with an "op" key.  An
+object with a "size" key is followed by that many bytes, a gzipped
+tar file of the paths it names (made relative to "/").
+
+  client                       worker
+  {op:hello, token}        ->
+                           <-  {op:hello, slots, jobs}
+  {op:job, token, commands,->
+   env, ship, roots}
+                           <-  {op:need, paths}
+  {op:tar, paths, size}    ->  (for each needed path)
+                           <-  {op:log, stage, line} ...
+                           <-  {op:stage, stage, status, paths, size}
+                           ...
+                           <-  {op:result}
+
+A worker answers a message with a wrong token with {op:error, message}.
+
+usage: python dispatch.py worker [options]
+'''
+
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import shutil
+import socket
+import atexit
+import tarfile
+import binascii
+import tempfile
+import optparse
+import threading
+import subprocess
+import SocketServer
+
+from metascons.manifest import metadir, manifest_path, file_digest
+
+# the stages sent to workers, in order
+stages = ['prepare', 'build', 'install']
+
+# the environment variable holding the token shared with workers
+token_variable = 'METASCONS_DISPATCH_TOKEN'
+
+def send(fp, msg, payload=None):
+    'Write the message and the payload file, if any'
+    if payload:
+        payload.seek(0, 2)
+        msg = dict(msg, size=payload.tell())
+        payload.seek(0)
+        pass
+    fp.write(json.dumps(msg) + '\n')
+    if payload:
+        shutil.copyfileobj(payload, fp)
+    fp.flush()
+    return
+
+def receive(fp):
+    '''
+    Return the next message and its payload as a file object (or None).
+    Raise EOFError if the connection is closed.
+    '''
+    line = fp.readline()
+    if not line:
+        raise EOFError('connection closed')
+    msg = json.loads(line)
+    if 'size' not in msg:
+        return msg, None
+    payload = tempfile.SpooledTemporaryFile(1<<20)
+    left = msg['size']
+    while left:
+        data = fp.read(min(left, 1<<16))
+        if not data:
+            raise EOFError('connection closed in payload')
+        payload.write(data)
+        left -= len(data)
+        continue
+    payload.seek(0)
+    return msg, payload
+
+def skip_metadir(info):
+    'A tarfile filter leaving out manifests, which each side makes itself'
+    if ('/%s/' % metadir) in ('/' + info.name + '/'):
+        return None
+    return info
+
+def pack(paths, root=''):
+    '''
+    Return a file holding a gzipped tar of the existing paths as found
+    below root and named relative to "/".
+    '''
+    out = tempfile.SpooledTemporaryFile(1<<20)
+    tar = tarfile.open(fileobj=out, mode='w:gz')
+    for path in paths:
+        if os.path.lexists(root + path):
+            tar.add(root + path, arcname=path.lstrip('/'), filter=skip_metadir)
+        continue
+    tar.close()
+    return out
+
+def within(path, dirs):
+    'Return True if the absolute path is one of dirs or below one'
+    for d in dirs:
+        d = d.rstrip('/')
+        if path == d or path.startswith(d + '/'):
+            return True
+        continue
+    return False
+
+def check_members(tar, allowed):
+    '''
+    Raise ValueError unless all members of the tar file made by pack()
+    are files, directories or links below the allowed absolute paths,
+    links point there too and no member is below a symbolic link.
+    '''
+    def member_path(name):
+        if name.startswith('/') or '..' in name.split('/'):
+            raise ValueError('unsafe path in tar file: %s' % name)
+        path = '/' + os.path.normpath(name).lstrip('/')
+        if not within(path, allowed):
+            raise ValueError('unexpected path in tar file: %s' % name)
+        return path
+    members = tar.getmembers()
+    links = set(member_path(info.name) for info in members if info.issym())
+    for info in members:
+        path = member_path(info.name)
+        parent = os.path.dirname(path)
+        while parent != '/':
+            if parent in links:
+                raise ValueError('path below a link in tar file: %s' % \
+                                     info.name)
+            parent = os.path.dirname(parent)
+            continue
+        if info.issym():
+            target = os.path.normpath(os.path.join(os.path.dirname(path),
+                                                   info.linkname))
+            if not within(target, allowed):
+                raise ValueError('link leading out in tar file: %s -> %s' % \
+                                     (info.name, info.linkname))
+        elif info.islnk():
+            member_path(info.linkname)
+        elif not (info.isfile() or info.isdir()):
+            raise ValueError('special file in tar file: %s' % info.name)
+        continue
+    return
+
+def unpack(payload, allowed, root=''):
+    '''
+    Unpack a file made by pack() of the allowed paths below root.
+    Raise ValueError, unpacking nothing, if it holds anything else.
+    '''
+    tar = tarfile.open(fileobj=payload, mode='r:gz')
+    try:
+        check_members(tar, allowed)
+        tar.extractall(root or '/')
+    finally:
+        tar.close()
+    return
+
+def directory_digest(path, stage):
+    'Return the digest of the manifest of the directory or None'
+    try:
+        return file_digest(manifest_path(path, stage))
+    except IOError:
+        return None
+
+def parse_address(addr):
+    'Return the socket family and address of "host:port" or a path'
+    if '/' in addr:
+        return socket.AF_UNIX, addr
+    host, port = addr.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+def connect(addr):
+    family, address = parse_address(addr)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+class Relocator(object):
+    '''
+    Move absolute paths starting with one of the given prefixes below
+    root.  With no root nothing moves.
+    '''
+    def __init__(self, root, prefixes=()):
+        self.root = root and root.rstrip('/') or ''
+        prefixes = sorted(set(p.rstrip('/') for p in prefixes if p), key=len,
+                          reverse=True)
+        self.regex = None
+        if self.root and prefixes:
+            self.regex = re.compile(r'(?<![\w.-])(%s)(?![\w.-])' % \
+                                        '|'.join(map(re.escape, prefixes)))
+        return
+
+    def path(self, path):
+        return self.root + os.path.abspath(path)
+
+    def text(self, text):
+        if not self.regex: return text
+        return self.regex.sub(lambda m: self.root + m.group(1), text)
+
+    pass
+
+class WorkerHandler(SocketServer.StreamRequestHandler):
+    'Serve one connection to a worker'
+
+    def handle(self):
+        try:
+            msg, payload = receive(self.rfile)
+        except (EOFError, ValueError):
+            return
+        token = str(msg.get('token') or '')
+        if not hmac.compare_digest(token, self.server.token):
+            send(self.wfile, {'op': 'error', 'message': 'bad token'})
+            return
+        if msg['op'] == 'hello':
+            send(self.wfile, {'op': 'hello', 'slots': self.server.slots,
+                              'jobs': self.server.jobs})
+            return
+        if msg['op'] == 'job':
+            self.server.sem.acquire()
+            try:
+                self.job(msg)
+            finally:
+                self.server.sem.release()
+            return
+        return
+
+    def job(self, msg):
+        server = self.server
+        reloc = Relocator(server.root, msg['roots'])
+
+        with server.lock:
+            need = sorted(p for p,dg in msg['ship'].iteritems() \
+                              if dg is None or server.shipped.get(p) != dg)
+            send(self.wfile, {'op': 'need', 'paths': need})
+            for ind in range(len(need)):
+                tmsg, payload = receive(self.rfile)
+                if [p for p in tmsg['paths'] if p not in need]:
+                    send(self.wfile, {'op': 'error',
+                                      'message': 'unexpected paths'})
+                    return
+                for path in tmsg['paths']:
+                    shutil.rmtree(reloc.path(path), True)
+                    continue
+                try:
+                    unpack(payload, tmsg['paths'], server.root)
+                except (ValueError, tarfile.TarError), err:
+                    send(self.wfile, {'op': 'error', 'message': str(err)})
+                    return
+                for path in tmsg['paths']:
+                    server.shipped[path] = msg['ship'][path]
+                    continue
+                continue
+            server.save()
+            pass
+
+        env = dict([(str(k), reloc.text(v).encode('utf-8')) \
+                        for k,v in msg['env'].iteritems()])
+        for cmd in msg['commands']:
+            stage = cmd['stage']
+            cwd = reloc.path(cmd['cwd'])
+            try:
+                if not os.path.isdir(cwd):
+                    os.makedirs(cwd)
+                proc = subprocess.Popen(reloc.text(cmd['command']).encode('utf-8'),
+                                        shell=True, cwd=cwd, env=env,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, close_fds=True)
+            except OSError, err:
+                send(self.wfile, {'op': 'log', 'stage': stage,
+                                  'line': 'worker: %s\n' % err})
+                send(self.wfile, {'op': 'stage', 'stage': stage, 'status': 127})
+                break
+            for line in iter(proc.stdout.readline, ''):
+                send(self.wfile, {'op': 'log', 'stage': stage,
+                                  'line': line.decode('utf-8', 'replace')})
+                continue
+            status = proc.wait()
+            fetch = not status and cmd['fetch'] or []
+            send(self.wfile, {'op': 'stage', 'stage': stage, 'status': status,
+                              'paths': fetch},
+                 fetch and pack(fetch, server.root) or None)
+            if status: break
+            continue
+
+        send(self.wfile, {'op': 'result'})
+        return
+
+    pass
+
+class Worker(SocketServer.ThreadingMixIn):
+    '''
+    Mixin for a server running job chains of clients giving the token,
+    at most slots at once, each with the given number of make jobs.
+    Paths are moved below root, if given.  What was shipped is
+    remembered in the state directory.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def setup_worker(self, token, slots, jobs, root, state):
+        self.token = str(token)
+        self.slots = slots
+        self.jobs = jobs
+        self.root = root and os.path.abspath(root) or ''
+        self.sem = threading.Semaphore(slots)
+        self.lock = threading.Lock()
+        self.state = os.path.join(state, 'shipped.json')
+        try:
+            self.shipped = json.load(open(self.state))
+        except (IOError, ValueError):
+            self.shipped = {}
+        if not os.path.isdir(state):
+            os.makedirs(state)
+        return
+
+    def save(self):
+        tmp = self.state + '.tmp'
+        json.dump(self.shipped, open(tmp, 'w'))
+        os.rename(tmp, self.state)
+        return
+
+    pass
+
+class TCPWorker(Worker, SocketServer.TCPServer): pass
+class UnixWorker(Worker, SocketServer.UnixStreamServer): pass
+
+def serve(listen, token, slots=1, jobs=1, root=None, state=None):
+    'Run a worker for clients giving the token forever'
+    assert token, 'Workers need a token'
+    family, address = parse_address(listen)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixWorker(address, WorkerHandler)
+    else:
+        server = TCPWorker(address, WorkerHandler)
+    state = state or root or os.path.join(os.path.expanduser('~'),
+                                          '.cache', 'metascons-worker')
+    server.setup_worker(token, slots, jobs, root, state)
+    server.serve_forever()
+    return
+
+class LocalPool(object):
+    '''
+    A number of worker processes on this machine, each with one slot,
+    listening on Unix sockets in a temporary directory and sharing a
+    new random token.  Unless shared each works below its own root
+    there.
+    '''
+    def __init__(self, nworkers, shared=False, jobs=None):
+        self.dir = tempfile.mkdtemp(prefix='metascons-workers-')
+        self.token = binascii.hexlify(os.urandom(16))
+        jobs = jobs or max(1, cpu_count() // nworkers)
+        me = os.path.abspath(__file__)
+        if me[-4:] in ['.pyc','.pyo']:
+            me = me[:-1]
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(me))] + \
+                [p for p in env.get('PYTHONPATH','').split(os.pathsep) if p])
+        env[token_variable] = self.token
+        self.addresses = []
+        self.procs = []
+        for ind in range(nworkers):
+            wdir = os.path.join(self.dir, 'w%d' % ind)
+            os.makedirs(wdir)
+            addr = os.path.join(wdir, 'socket')
+            cmd = [sys.executable, me, 'worker', '--listen', addr,
+                   '--jobs', str(jobs), '--state', wdir]
+            if not shared:
+                cmd += ['--root', wdir]
+            self.procs.append(subprocess.Popen(cmd, env=env, close_fds=True))
+            self.addresses.append(addr)
+            continue
+        atexit.register(self.stop)
+        for addr in self.addresses:
+            for count in range(100):
+                if os.path.exists(addr): break
+                time.sleep(0.1)
+                continue
+            continue
+        return
+
+    def stop(self):
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+            continue
+        shutil.rmtree(self.dir, True)
+        return
+
+    pass
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def env_strings(penv):
+    'Return the ENV dictionary with string values as a command would see'
+    ret = {}
+    for key,val in penv.iteritems():
+        if isinstance(val, (list, tuple)) or hasattr(val, 'data'):
+            val = ':'.join(map(str, val))
+        ret[key] = str(val)
+        continue
+    return ret
+
+class Dispatcher(object):
+    '''
+    Send the stage chains of packages to workers.  The spec is a
+    comma-separated list of worker addresses and "local:N" pools.
+    The token of workers not in a pool defaults to that in the
+    environment.
+    '''
+    def __init__(self, spec, shared=False, out=sys.stdout, token=None):
+        token = token or os.environ.get(token_variable)
+        self.shared = shared
+        self.out = out
+        self.outlock = threading.Lock()
+        self.cond = threading.Condition()
+        self.workers = []       # [address, slots, jobs, busy]
+        self.tokens = {}        # address to token
+        self.pools = []
+        for item in spec.split(','):
+            item = item.strip()
+            if item.startswith('local:'):
+                pool = LocalPool(int(item[len('local:'):]), shared)
+                self.pools.append(pool)
+                addrs = pool.addresses
+                wtoken = pool.token
+            else:
+                addrs = [item]
+                wtoken = token
+            for addr in addrs:
+                assert wtoken, 'No token for worker %s, set %s' % \
+                    (addr, token_variable)
+                self.tokens[addr] = wtoken
+                sock = connect(addr)
+                fp = sock.makefile('rwb')
+                send(fp, {'op': 'hello', 'token': wtoken})
+                msg, payload = receive(fp)
+                sock.close()
+                assert msg['op'] == 'hello', \
+                    'Worker %s refused: %s' % (addr, msg.get('message'))
+                self.workers.append([addr, msg['slots'], msg['jobs'], 0])
+                continue
+            continue
+        self.packages = {}
+        self.results = {}
+        self.payloads = {}
+        return
+
+    def add_package(self, pname, sourcedir, installdir, depdirs, actions):
+        '''
+        Take the package if the actions of all dispatched stages are
+        command strings.  Return True if taken.
+        '''
+        if [st for st in stages if not isinstance(actions.get(st), basestring)]:
+            return False
+        self.packages[pname] = {
+            'sourcedir': os.path.abspath(sourcedir),
+            'installdir': os.path.abspath(installdir),
+            'depdirs': [os.path.abspath(d) for d in depdirs],
+            'actions': actions, 'nodes': {}, 'lock': threading.Lock()}
+        return True
+
+    def has(self, pname):
+        return pname in self.packages
+
+    def add_stage(self, pname, stage, targets, source):
+        'Record the target and source files of a stage of a taken package'
+        if pname in self.packages and stage in stages:
+            self.packages[pname]['nodes'][stage] = (targets, source)
+        return
+
+    def wrap(self, pname, stage, action):
+        'Return a DispatchedAction if the package stage is dispatched'
+        if stage not in stages or pname not in self.packages:
+            return action
+        return DispatchedAction(self, pname, stage, action)
+
+    def acquire(self):
+        'Return the worker with the most free slots, waiting for one'
+        with self.cond:
+            while True:
+                free = [w for w in self.workers if w[3] < w[1]]
+                if free: break
+                self.cond.wait()
+                continue
+            worker = max(free, key=lambda w: w[1] - w[3])
+            worker[3] += 1
+            return worker
+
+    def release(self, worker):
+        with self.cond:
+            worker[3] -= 1
+            self.cond.notify()
+        return
+
+    def log(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        with self.outlock:
+            self.out.write(text)
+            self.out.flush()
+        return
+
+    def run(self, pname, stage, env):
+        '''
+        Run the stage, return its status.  In shared mode just the
+        stage is run.  Otherwise the whole chain is, as the worker may
+        not have the results of the earlier stages, and what the stage
+        and the later ones made is kept to be unpacked when SCons runs
+        them (after it removed their old targets).
+        '''
+        pkg = self.packages[pname]
+        with pkg['lock']:
+            if (pname, stage) not in self.results:
+                if self.shared:
+                    chain = [stage]
+                else:
+                    chain = stages
+                self.run_chain(pname, chain, stage, env)
+                pass
+            payload, paths = self.payloads.pop((pname, stage), (None, None))
+            if payload:
+                try:
+                    unpack(payload, paths)
+                except (ValueError, tarfile.TarError), err:
+                    self.log('bad result of %s %s: %s\n' % (pname, stage, err))
+                    return 1
+            return self.results.get((pname, stage), 1)
+
+    def run_chain(self, pname, chain, wanted, env):
+        import SCons.Subst
+        pkg = self.packages[pname]
+        worker = self.acquire()
+        try:
+            jenv = env.Override({'MAKE_JOBS': str(worker[2])})
+            top = env.Dir('#').abspath
+            commands = []
+            for stage in chain:
+                targets, source = pkg['nodes'][stage]
+                tnodes = env.arg2nodes(targets, env.fs.File)
+                snodes = env.arg2nodes(source, env.fs.File)
+                command = jenv.subst(pkg['actions'][stage], SCons.Subst.SUBST_CMD,
+                                     tnodes, snodes)
+                fetch = []
+                if not self.shared and stages.index(stage) >= stages.index(wanted):
+                    fetch = [t.abspath for t in tnodes]
+                    if stage == 'install':
+                        fetch = [pkg['installdir']] + fetch
+                    pass
+                commands.append({'stage': stage, 'command': command,
+                                 'cwd': top, 'fetch': fetch})
+                continue
+
+            ship = {}
+            if not self.shared:
+                ship[pkg['sourcedir']] = directory_digest(pkg['sourcedir'], 'unpack')
+                for ddir in pkg['depdirs']:
+                    ship[ddir] = directory_digest(ddir, 'install')
+                    continue
+                pass
+            roots = [top, pkg['sourcedir'], pkg['installdir']] + pkg['depdirs']
+            self.log('dispatching %s %s to %s\n' % \
+                         (pname, ' '.join(chain), worker[0]))
+            self.exchange(pname, worker, {'op': 'job',
+                                          'token': self.tokens[worker[0]],
+                                          'commands': commands,
+                                          'env': env_strings(env['ENV']),
+                                          'ship': ship, 'roots': roots})
+        except (socket.error, EOFError, ValueError, KeyError), err:
+            self.log('dispatch of %s failed: %s\n' % (pname, err))
+        finally:
+            self.release(worker)
+        return
+
+    def exchange(self, pname, worker, job):
+        fetch = dict([(cmd['stage'], cmd['fetch']) for cmd in job['commands']])
+        sock = connect(worker[0])
+        fp = sock.makefile('rwb')
+        try:
+            send(fp, job)
+            while True:
+                msg, payload = receive(fp)
+                op = msg['op']
+                if op == 'need':
+                    for path in msg['paths']:
+                        send(fp, {'op': 'tar', 'paths': [path]}, pack([path]))
+                        continue
+                elif op == 'log':
+                    self.log('[%s %s] %s' % (pname, msg['stage'], msg['line']))
+                elif op == 'stage':
+                    self.results[(pname, msg['stage'])] = msg['status']
+                    if payload:
+                        # only what was asked for is unpacked
+                        self.payloads[(pname, msg['stage'])] = \
+                            (payload, fetch.get(msg['stage'], []))
+                elif op == 'error':
+                    self.log('worker %s refused %s: %s\n' % \
+                                 (worker[0], pname, msg['message']))
+                    break
+                elif op == 'result':
+                    break
+                continue
+        finally:
+            sock.close()
+        return
+
+    pass
+
+class DispatchedAction(object):
+    '''
+    A SCons function action for a stage of a dispatched package.  It
+    runs the chain from its stage on a worker unless that already
+    happened and returns how the stage went.
+    '''
+    def __init__(self, dispatcher, pname, stage, action):
+        from metascons.actions import scons_action
+        self.dispatcher = dispatcher
+        self.pname = pname
+        self.stage = stage
+        self.action = scons_action(action)
+        return
+
+    def __call__(self, target, source, env):
+        return self.dispatcher.run(self.pname, self.stage, env)
+
+    def strfunction(self, target, source, env):
+        'Show the wrapped action instead of this wrapper'
+        try:
+            return self.action.strfunction(target, source, env)
+        except AttributeError:
+            return self.action.genstring(target, source, env)
+
+    def get_contents(self, target, source, env):
+        'Let SCons sign the wrapped action instead of this wrapper'
+        return self.action.get_contents(target, source, env)
+
+    pass
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.split('usage: ')[-1].strip())
+    parser.add_option('-l','--listen', default='127.0.0.1:7777',
+                      help='HOST:PORT or Unix socket path to listen on (def=%default)')
+    parser.add_option('-s','--slots', type='int', default=1,
+                      help='Number of chains run at once (def=%default)')
+    parser.add_option('-j','--jobs', type='int', default=None,
+                      help='Make jobs per chain (def=CPUs/slots)')
+    parser.add_option('-r','--root', default=None,
+                      help='Directory to move all paths below (testing)')
+    parser.add_option('--state', default=None,
+                      help='Directory remembering what was shipped '
+                      '(def=root or ~/.cache/metascons-worker)')
+    opts, args = parser.parse_args(argv)
+    if args != ['worker']:
+        parser.error('Only the "worker" command is known')
+    token = os.environ.get(token_variable)
+    if not token:
+        parser.error('Set %s to the token shared with clients' % token_variable)
+    serve(opts.listen, token, opts.slots,
+          opts.jobs or max(1, cpu_count() // opts.slots),
+          opts.root, opts.state)
+    return 0
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
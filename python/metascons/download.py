@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+'''
+Built-in tarball downloader
+===========================
+
+This module replaces shelling out to wget for every package.  All
+downloads in a metascons run go through one Downloader which:
+
+* caps the number of transfers running at once across all packages,
+
+* caps the number of transfers to any one host and keeps idle HTTP
+  connections around so later tarballs from the same host reuse them,
+
+* resumes an interrupted transfer with a HTTP Range request, and
+
+* streams into PATH.part and only renames it to PATH when complete,
+  that is when as many bytes as the server announced were received
+  and any expected SHA-256 digest matches, so a partial or corrupt
+  file never looks like a finished download.
+
+URLs with schemes other than http and https (eg, ftp) are fetched with
+urllib2 without connection reuse or resuming.
+'''
+
+import os
+import re
+import socket
+import hashlib
+import httplib
+import urllib2
+import urlparse
+import threading
+
+from metascons import trace
+
+blocksize = 1<<16
+max_redirects = 5
+
+class Downloader(object):
+    '''
+    A pool of HTTP connections shared by all downloads.
+    '''
+    def __init__(self, maxjobs=4, perhost=2):
+        self.slots = threading.BoundedSemaphore(maxjobs)
+        self.perhost = perhost
+        self.lock = threading.Lock()
+        self.hosts = {}         # (scheme,netloc) -> semaphore
+        self.idle = {}          # (scheme,netloc) -> [connection]
+        return
+
+    def host_slot(self, key):
+        'Return the semaphore limiting transfers to one host'
+        self.lock.acquire()
+        try:
+            sem = self.hosts.get(key)
+            if not sem:
+                sem = threading.BoundedSemaphore(self.perhost)
+                self.hosts[key] = sem
+                pass
+            return sem
+        finally:
+            self.lock.release()
+
+    def connection(self, key):
+        'Return an idle connection to the host or make a new one'
+        self.lock.acquire()
+        try:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+        finally:
+            self.lock.release()
+        scheme,netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc), False
+        return httplib.HTTPConnection(netloc), False
+
+    def release(self, key, conn):
+        'Keep a connection for reuse by later downloads'
+        self.lock.acquire()
+        try:
+            self.idle.setdefault(key,[]).append(conn)
+        finally:
+            self.lock.release()
+        return
+
+    def close(self):
+        'Close all idle connections'
+        self.lock.acquire()
+        try:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+                    continue
+                continue
+            self.idle = {}
+        finally:
+            self.lock.release()
+        return
+
+    def fetch(self, url, path, hasher=None, sha256=None):
+        '''
+        Download url to the file path.  Data is streamed into
+        path.part which is renamed to path on success.  If path.part
+        exists from an earlier attempt the transfer is resumed.  If
+        given, hasher is updated with every byte of the final file.
+        If the hex SHA-256 digest sha256 is given (hasher, if given,
+        must then be a SHA-256 one) and the file does not match it,
+        path.part is removed and IOError raised.  Return the number of
+        bytes transferred.
+        '''
+        partial = path + '.part'
+        scheme = urlparse.urlsplit(url)[0]
+        if sha256 and not hasher:
+            hasher = hashlib.sha256()
+        self.slots.acquire()
+        try:
+            if scheme in ['http','https']:
+                nbytes = self.fetch_http(url, partial, hasher)
+            else:
+                nbytes = self.fetch_other(url, partial, hasher)
+        finally:
+            self.slots.release()
+        if sha256 and hasher.hexdigest() != sha256.lower():
+            os.remove(partial)
+            raise IOError('Checksum mismatch for %s: expected %s got %s' % \
+                              (url, sha256, hasher.hexdigest()))
+        os.rename(partial, path)
+        trace.count('downloaded', nbytes)
+        return nbytes
+
+    def fetch_other(self, url, partial, hasher):
+        'Fetch a non-HTTP URL from the start using urllib2'
+        src = urllib2.urlopen(url)
+        try:
+            nbytes = stream(src, open(partial,'wb'), hasher)
+            length = src.info().getheader('content-length')
+        finally:
+            src.close()
+        check_size(url, partial, length and int(length))
+        return nbytes
+
+    def fetch_http(self, url, partial, hasher):
+        'Fetch a HTTP URL, reusing connections and resuming partials'
+        for count in range(max_redirects):
+            scheme,netloc,upath,query,frag = urlparse.urlsplit(url)
+            key = (scheme,netloc)
+            sem = self.host_slot(key)
+            sem.acquire()
+            try:
+                resp,conn = self.request(key, upath, query, partial)
+                location = resp.getheader('location')
+                if resp.status in [301,302,303,307,308] and location:
+                    resp.read()
+                    self.done(key, conn, resp)
+                    url = urlparse.urljoin(url, location)
+                    continue
+                if resp.status == 416:
+                    # range not satisfiable, start over
+                    resp.read()
+                    self.done(key, conn, resp)
+                    os.remove(partial)
+                    continue
+                if resp.status not in [200,206]:
+                    resp.read()
+                    self.done(key, conn, resp)
+                    raise IOError('Download of %s failed: %d %s' % \
+                                      (url, resp.status, resp.reason))
+
+                length = resp.getheader('content-length')
+                size = length and int(length)
+                if resp.status == 206:
+                    offset = os.path.getsize(partial)
+                    start, total = content_range(resp.getheader('content-range'))
+                    if start != offset:
+                        # not what was asked for, start over
+                        conn.close()
+                        os.remove(partial)
+                        continue
+                    size = total or (length and offset + int(length))
+                    fp = open(partial,'ab')
+                    if hasher:
+                        prefix = open(partial,'rb')
+                        try:
+                            stream(prefix, None, hasher)
+                        finally:
+                            prefix.close()
+                        pass
+                else:
+                    fp = open(partial,'wb')
+                    pass
+                try:
+                    nbytes = stream(resp, fp, hasher)
+                    check_size(url, partial, size)
+                except:
+                    conn.close()
+                    raise
+                self.done(key, conn, resp)
+                return nbytes
+            finally:
+                sem.release()
+            continue
+        raise IOError('Download of %s failed: too many redirects' % url)
+
+    def request(self, key, upath, query, partial):
+        '''
+        Issue a GET for the path, asking for the remainder of any
+        partial file.  A reused connection that the server has since
+        closed is replaced by a fresh one.
+        '''
+        if query:
+            upath += '?' + query
+        headers = {}
+        if os.path.exists(partial):
+            offset = os.path.getsize(partial)
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+                pass
+            pass
+        while True:
+            conn,reused = self.connection(key)
+            try:
+                conn.request('GET', upath or '/', headers=headers)
+                return conn.getresponse(), conn
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                pass
+            continue
+
+    def done(self, key, conn, resp):
+        'Finish with a connection, keeping it if the server allows'
+        if resp.will_close:
+            conn.close()
+            return
+        self.release(key, conn)
+        return
+
+    pass
+
+def content_range(header):
+    '''
+    Return the first byte and the total size, or None if not known,
+    from a Content-Range header "bytes FIRST-LAST/TOTAL".
+    '''
+    match = re.match(r'\s*bytes\s+(\d+)-\d+/(\d+|\*)', header or '')
+    if not match:
+        raise IOError('Bad Content-Range: %s' % header)
+    total = match.group(2)
+    return int(match.group(1)), total != '*' and int(total) or None
+
+def check_size(url, partial, size):
+    '''
+    Raise IOError if the size of the partial file is not size, if
+    known.  The file is kept so the download can be resumed.
+    '''
+    if size is None: return
+    got = os.path.getsize(partial)
+    if got != size:
+        raise IOError('Download of %s incomplete: got %d of %d bytes' % \
+                          (url, got, size))
+    return
+
+def stream(src, dst, hasher=None):
+    '''
+    Copy the file-like src to dst (which is closed after), updating
+    any hasher.  Return number of bytes copied.
+    '''
+    nbytes = 0
+    try:
+        while True:
+            data = src.read(blocksize)
+            if not data: break
+            if hasher: hasher.update(data)
+            if dst: dst.write(data)
+            nbytes += len(data)
+            continue
+    finally:
+        if dst: dst.close()
+    return nbytes
+
+
+downloader = Downloader()
+
+def configure(maxjobs=None, perhost=None):
+    '''
+    Replace the shared downloader with one having the given limits.
+    Called by metascons before any download runs.
+    '''
+    global downloader
+    downloader.close()
+    downloader = Downloader(int(maxjobs or 4), int(perhost or 2))
+    return downloader
+
+def fetch(url, path, hasher=None, sha256=None):
+    'Download url to path with the shared downloader'
+    return downloader.fetch(url, path, hasher, sha256)
+
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+'''
+Run-time environment dump files
+===============================
+
+The file written by "metascons --environment-file=FILE" holds the
+environment variables needed to use the installed packages.  It is
+JSON of the form:
+
+::
+
+  {"format": "metascons-env", "version": 1,
+   "env": {"PATH": ["/path/one", "/path/two"], "FOO": "bar"}}
+
+PATH-like variables are lists, all others are strings.  JSON loads
+quickly and, unlike the old Python repr() format, without eval().
+Files in the old format are still read.
+'''
+
+import os
+import ast
+import json
+
+from metascons.util import PathList
+
+FORMAT = 'metascons-env'
+VERSION = 1
+
+def dump(env, path):
+    'Write the environment dictionary env to the dump file at path'
+    out = {}
+    for key,val in env.iteritems():
+        if isinstance(val, (list,PathList)):
+            val = list(val)
+        out[key] = val
+        continue
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    fp = open(tmp,'w')
+    json.dump({'format':FORMAT, 'version':VERSION, 'env':out}, fp,
+              sort_keys=True, separators=(',',':'))
+    fp.close()
+    os.rename(tmp, path)
+    return
+
+def load(path):
+    'Return the environment dictionary held in the dump file at path'
+    text = open(path).read()
+    try:
+        dat = json.loads(text)
+    except ValueError:
+        return ast.literal_eval(text) # old repr() format
+    if not isinstance(dat, dict) or dat.get('format') != FORMAT:
+        raise ValueError('Not a metascons environment file: %s' % path)
+    if dat.get('version', 0) > VERSION:
+        raise ValueError('Environment file %s has version %s, newer than %d' % \
+                             (path, dat.get('version'), VERSION))
+    return encoded(dat['env'])
+
+def encoded(val):
+    'Return val with any unicode strings from JSON made into str'
+    if isinstance(val, unicode):
+        return val.encode('utf-8')
+    if isinstance(val, list):
+        return [encoded(v) for v in val]
+    if isinstance(val, dict):
+        return dict([(encoded(k), encoded(v)) for k,v in val.iteritems()])
+    return val
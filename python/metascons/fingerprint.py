@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+Package fingerprints
+====================
+
+Each package's chain of stages is rooted at SCons Value nodes holding
+digests of just what goes into that package, instead of at the whole
+configuration file:
+
+source fingerprint
+
+  The package name and version and where its tarball comes from and
+  goes to.  The download stage depends on it so a new version or URL
+  fetches the tarball again.
+
+install identity
+
+  The source fingerprint plus the platform, the install directory and
+  the install identities of the packages it depends on.  This is what
+  a dependent package sees of it.
+
+build fingerprint
+
+  The install identity plus the source code of the wrapper module and
+  its base classes, the command of each stage as it is run (recipe
+  commands and make options substituted) and the package's ENV
+  (eg, that of its variant) but for proxies and the METASCONS_*
+  variables set anew for each run.  The prepare stage depends on it so
+  editing a wrapper or recipe rebuilds the package but does not
+  download or unpack it again.
+
+Editing the version of one package thus changes only the fingerprints
+of that package and those depending on it.  Editing just its wrapper
+changes only its own build fingerprint; its dependents are rebuilt
+only if what it installs changes (see metascons.manifest).
+'''
+
+import hashlib
+
+from metascons.artifacts import wrapper_sources, action_string, stages
+
+def digest(items):
+    'Return the hex SHA-1 digest of the strings in items'
+    hasher = hashlib.sha1()
+    for item in items:
+        hasher.update(str(item) + '\0')
+        continue
+    return hasher.hexdigest()
+
+def source_fingerprint(pobj):
+    'Return the digest of what determines the package source'
+    return digest([pobj.name(), pobj.version(), pobj.tarballurl(),
+                   pobj.tarballpath(), pobj.tarballsha256(),
+                   pobj.sourcedir(), pobj.unpack_strip()])
+
+def install_identity(pobj, depidents):
+    '''
+    Return the digest of which package is installed where given the
+    install identities of the packages it depends on.
+    '''
+    return digest([source_fingerprint(pobj), pobj.env['PLATFORM'],
+                   pobj.installdir()] + sorted(depidents))
+
+def build_fingerprint(pobj, identity):
+    '''
+    Return the digest of what determines the built package given its
+    install identity.
+    '''
+    env = pobj.env
+    commands = [stage + ':' + action_string(getattr(pobj, stage + '_action')(), env) \
+                    for stage in stages]
+    # proxies only matter to downloads, which the source fingerprint
+    # covers, and METASCONS_* (eg, the compiler cache's build id) to
+    # the run
+    penv = ['%s=%s' % (key, val) for key, val in sorted(env['ENV'].items()) \
+                if not key.lower().endswith('_proxy') \
+                and not key.startswith('METASCONS_')]
+    return digest([identity, wrapper_sources(pobj)] + commands + penv)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+'''
+CPU budget scheduler
+====================
+
+When scons runs several package stages at once (scons -j) each one
+that runs make needs to know how many jobs it may use.  This module
+holds one global budget of job tokens and lends them out to stages.
+
+The budget is kept in a GNU make jobserver pipe: one byte in the pipe
+is one free job slot and the process itself holds one implicit slot.
+If metascons is itself run from a make that passes a jobserver in
+MAKEFLAGS, that pipe is used so metascons shares the parent's budget.
+Otherwise a new pipe is filled with budget-1 tokens.
+
+A stage takes at least one token, waiting for it, then as many more
+as are free.  It runs its make with -j set to the number of tokens
+held (via the MAKE_JOBS construction variable) and returns them all
+when done.  Packages on the critical path of the dependency graph are
+served first when several stages are waiting, and while others wait a
+stage takes no more than its package's share of the budget, larger
+for higher priorities.
+'''
+
+import os
+import re
+import fcntl
+import errno
+import heapq
+import select
+import threading
+
+def cpu_count():
+    'Return the number of CPUs, 1 if not known'
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def parent_jobserver(makeflags=None):
+    '''
+    Return the (read,write) file descriptors of a jobserver passed
+    down in MAKEFLAGS or None.
+    '''
+    if makeflags is None:
+        makeflags = os.environ.get('MAKEFLAGS','')
+    m = re.search(r'--jobserver-(?:auth|fds)=(\d+),(\d+)', makeflags)
+    if not m: return None
+    fds = (int(m.group(1)), int(m.group(2)))
+    for fd in fds:
+        try:
+            os.fstat(fd)
+        except OSError:
+            return None         # parent did not really pass them
+        continue
+    return fds
+
+def nonblocking_reader(fd):
+    '''
+    Return a descriptor reading the pipe fd without blocking.  The
+    pipe may be shared with other processes so a new open file
+    description is made rather than changing the flags of fd.
+    '''
+    try:
+        return os.open('/proc/self/fd/%d' % fd, os.O_RDONLY|os.O_NONBLOCK)
+    except OSError:
+        return None
+
+class JobServer(object):
+    '''
+    A global budget of job tokens lent to package stages.
+    '''
+
+    poll = 0.05                 # seconds between checks for tokens
+
+    def __init__(self, budget=None, makeflags=None):
+        self.budget = int(budget or cpu_count())
+        fds = parent_jobserver(makeflags)
+        if fds:
+            self.rfd,self.wfd = fds
+            self.inherited = True
+        else:
+            self.rfd,self.wfd = os.pipe()
+            os.write(self.wfd, '+' * (self.budget-1))
+            self.inherited = False
+            pass
+        self.reader = nonblocking_reader(self.rfd)
+        if self.reader is None and not self.inherited:
+            flags = fcntl.fcntl(self.rfd, fcntl.F_GETFL)
+            fcntl.fcntl(self.rfd, fcntl.F_SETFL, flags|os.O_NONBLOCK)
+            self.reader = self.rfd
+            pass
+
+        self.implicit = True    # our own slot is free
+        self.cond = threading.Condition()
+        self.waiters = []       # heap of (-priority, seq)
+        self.seq = 0
+        self.priorities = {}
+        return
+
+    def set_priorities(self, priorities):
+        '''
+        Set the priority of each package, a dictionary mapping package
+        name to a positive number.  Higher priority packages are served
+        first and get a larger share of the tokens while other stages
+        are waiting.  Packages with the highest priority may use the
+        whole budget.
+        '''
+        self.priorities = dict(priorities)
+        return
+
+    def priority(self, pname):
+        return self.priorities.get(pname, 1)
+
+    def allowance(self, pname):
+        '''
+        Return the most tokens a stage of the package may hold while
+        other stages are waiting for tokens.
+        '''
+        if not self.priorities:
+            return self.budget
+        top = max(self.priorities.values())
+        share = self.budget * self.priority(pname) // top
+        return max(1, min(self.budget, share))
+
+    def take(self):
+        '''
+        Take one free token without blocking.  Return it or None.
+        Must be called with the condition held.
+        '''
+        if self.implicit:
+            self.implicit = False
+            return ''
+        if self.reader is not None:
+            try:
+                tok = os.read(self.reader, 1)
+            except OSError, err:
+                if err.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return None
+                raise
+            return tok or None
+        # last resort for a shared pipe we cannot reopen
+        ready = select.select([self.rfd],[],[],0)[0]
+        if not ready: return None
+        return os.read(self.rfd, 1) or None
+
+    def acquire(self, want=1, priority=1, share=None):
+        '''
+        Block until at least one token is held and take up to want
+        without further waiting.  Waiters with higher priority are
+        served first, so those still waiting have no higher priority,
+        and are left the tokens beyond share (default: want).  Return
+        the list of tokens held.
+        '''
+        if share is None:
+            share = want
+        self.cond.acquire()
+        try:
+            self.seq += 1
+            me = (-priority, self.seq)
+            heapq.heappush(self.waiters, me)
+            while True:
+                if self.waiters[0] == me:
+                    tok = self.take()
+                    if tok is not None:
+                        break
+                    pass
+                self.cond.wait(self.poll)
+                continue
+            heapq.heappop(self.waiters)
+            tokens = [tok]
+            while len(tokens) < want:
+                if len(tokens) >= share and self.waiters: break
+                tok = self.take()
+                if tok is None: break
+                tokens.append(tok)
+                continue
+            self.cond.notify_all()
+            return tokens
+        finally:
+            self.cond.release()
+
+    def release(self, tokens):
+        'Return tokens taken by acquire()'
+        self.cond.acquire()
+        try:
+            for tok in tokens:
+                if tok == '':
+                    self.implicit = True
+                    continue
+                os.write(self.wfd, tok)
+                continue
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        return
+
+    def wrap(self, pname, action):
+        'Return a SlotAction running action with tokens from this budget'
+        return SlotAction(self, pname, action)
+
+    pass
+
+class SlotAction(object):
+    '''
+    A SCons function action which holds job tokens while it runs the
+    wrapped action with MAKE_JOBS set to the number of tokens held.
+    Commands should exclude $MAKE_JOBS from their signature, eg
+    "make $( -j$MAKE_JOBS $)", so the number of slots given to a
+    stage does not cause a rebuild.
+    '''
+    def __init__(self, jobserver, pname, action):
+        from metascons.actions import scons_action
+        self.jobserver = jobserver
+        self.pname = pname
+        self.action = scons_action(action)
+        return
+
+    def __call__(self, target, source, env):
+        js = self.jobserver
+        tokens = js.acquire(js.budget, js.priority(self.pname),
+                            js.allowance(self.pname))
+        try:
+            jenv = env.Override({'MAKE_JOBS': str(len(tokens))})
+            return self.action(target, source, jenv, show=0)
+        finally:
+            js.release(tokens)
+
+    def strfunction(self, target, source, env):
+        'Show the wrapped action instead of this wrapper'
+        try:
+            return self.action.strfunction(target, source, env)
+        except AttributeError:
+            return self.action.genstring(target, source, env)
+
+    def get_contents(self, target, source, env):
+        'Let SCons sign the wrapped action instead of this wrapper'
+        return self.action.get_contents(target, source, env)
+
+    pass
+
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+'''
+Layered construction environments
+=================================
+
+Giving every package a full Clone() of the construction environment
+and then copying in the variables of all its dependencies costs memory
+and time in proportion to packages times variables.  Instead, each
+package gets a LayeredEnvironment which holds:
+
+* only the variables set for the package itself (and its own copy of
+  the small ENV dictionary),
+
+* a reference to the shared base environment and
+
+* references to the LayeredEnvironments of its dependencies.
+
+Looking up a variable resolves it through this chain following the
+same rules as merge_env(): the package's own value wins, PATH-like
+variables get the dependencies' entries prepended and everything in
+ENV is merged likewise.  Resolved values are remembered until the
+layer or one below it changes, each layer telling those above it.  A
+full dictionary of the variables is only made when
+SCons substitutes an action, ie, when a stage actually runs.
+'''
+
+import itertools
+import SCons.Environment
+
+from metascons.util import merge_dict, is_path_var
+
+missing = object()
+
+class LayeredEnvironment(SCons.Environment.OverrideEnvironment):
+    '''
+    A construction environment holding one package's variables on top
+    of a base environment and the environments of its dependencies.
+    '''
+    def __init__(self, subject, overrides=None):
+        SCons.Environment.OverrideEnvironment.__init__(self, subject,
+                                                       overrides or {})
+        self.__dict__['layers'] = []
+        self.__dict__['dependents'] = []
+        self.__dict__['resolved'] = {}
+        self.__dict__['flattened'] = None
+        return
+
+    def add_layer(self, other):
+        'Add the environment of a dependency below this one'
+        self.__dict__['layers'].append(other)
+        other.__dict__['dependents'].append(self)
+        self.forget()
+        return
+
+    def forget(self):
+        '''
+        Forget the values resolved by this layer and by all layers
+        above it.  A layer resolving a value resolves it in all layers
+        below it, so one with nothing resolved has nothing above it to
+        forget either.
+        '''
+        todo = [self]
+        while todo:
+            env = todo.pop()
+            cache = env.__dict__['resolved']
+            if not cache: continue
+            cache.clear()
+            env.__dict__['flattened'] = None
+            todo.extend(env.__dict__['dependents'])
+            continue
+        return
+
+    def own(self, key):
+        'Return the value set on this layer or in the base or missing'
+        try:
+            return self.__dict__['overrides'][key]
+        except KeyError:
+            return self.__dict__['__subject'].get(key, missing)
+
+    def own_ENV(self):
+        '''
+        Return this layer's own copy of the ENV dictionary, made from
+        the base on first use.  ENV is small and is commonly changed in
+        place so, unlike other variables, each layer keeps a copy into
+        which the ENV of lower layers is merged.
+        '''
+        overrides = self.__dict__['overrides']
+        try:
+            return overrides['ENV']
+        except KeyError:
+            pass
+        penv = dict(self.__dict__['__subject']['ENV'])
+        overrides['ENV'] = penv
+        return penv
+
+    def resolve(self, key):
+        '''
+        Return the value of the variable key merged from this layer
+        and all below it, or missing.
+        '''
+        cache = self.__dict__['resolved']
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+
+        merged = {}
+        if key == 'ENV':
+            merged['ENV'] = self.own_ENV()
+        else:
+            val = self.own(key)
+            if val is not missing:
+                merged[key] = val
+            pass
+        # other variables simply take the first value found
+        several = key == 'ENV' or is_path_var(key)
+        layers = self.__dict__['layers']
+        # direct dependencies first, then all they depend on
+        below = itertools.chain((layer.own(key) for layer in layers),
+                                (layer.resolve(key) for layer in layers))
+        for val in below:
+            if merged and not several: break
+            if val is missing: continue
+            merge_dict(merged, {key:val})
+            continue
+
+        val = merged.get(key, missing)
+        cache[key] = val
+        return val
+
+    def layer_keys(self):
+        'Return the names of the variables set in this or any lower layer'
+        keys = set()
+        todo = [self]
+        seen = set()
+        while todo:
+            env = todo.pop()
+            if id(env) in seen: continue
+            seen.add(id(env))
+            keys.update(env.__dict__['overrides'].keys())
+            todo.extend(env.__dict__['layers'])
+            continue
+        return keys
+
+    def flatten(self):
+        '''
+        Return a dictionary of the variables that differ from the base
+        environment with their resolved values.  It is remembered like
+        the values and must not be changed.
+        '''
+        ret = self.__dict__['flattened']
+        if ret is not None:
+            return ret
+        ret = {}
+        subject = self.__dict__['__subject']
+        keys = self.layer_keys()
+        keys.add('ENV')
+        for key in subject.Dictionary().keys():
+            if is_path_var(key):
+                keys.add(key)
+            continue
+        for key in keys:
+            val = self.resolve(key)
+            if val is missing: continue
+            ret[key] = val
+            continue
+        self.__dict__['flattened'] = ret
+        return ret
+
+    # Methods that make this class act like a dictionary.
+    def __getitem__(self, key):
+        val = self.resolve(key)
+        if val is missing:
+            raise KeyError(key)
+        return val
+    def __setitem__(self, key, value):
+        SCons.Environment.OverrideEnvironment.__setitem__(self, key, value)
+        self.forget()
+    def __delitem__(self, key):
+        self.forget()
+        return SCons.Environment.OverrideEnvironment.__delitem__(self, key)
+    def get(self, key, default=None):
+        val = self.resolve(key)
+        if val is missing:
+            return default
+        return val
+    def has_key(self, key):
+        return self.resolve(key) is not missing
+    def __contains__(self, key):
+        return self.resolve(key) is not missing
+    def Dictionary(self):
+        d = self.__dict__['__subject'].Dictionary().copy()
+        d.update(self.flatten())
+        return d
+    def _update(self, dict):
+        SCons.Environment.OverrideEnvironment._update(self, dict)
+        self.forget()
+
+    def lvars(self):
+        lvars = self.__dict__['__subject'].lvars()
+        lvars.update(self.flatten())
+        return lvars
+
+    def Command(self, target, source, action, **kw):
+        'Make the builder use this environment, not the base'
+        return SCons.Environment.Base.Command(self, target, source,
+                                              action, **kw)
+
+    pass
+
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+'''
+Stage manifests
+===============
+
+After each of the unpack, prepare, build and install stages metascons
+writes a manifest of what the stage left in the package's source
+directory (unpack, prepare, build) or install directory (install).
+The manifest holds one line per file with its content digest, size,
+permissions and relative path, sorted by path.
+
+The next stage, and for the install manifest the prepare stage of
+each dependent package, depends on the manifest instead of on the
+stage's target file.  SCons decides with MD5-timestamp, so a manifest
+whose time is unchanged is not read and one that was rewritten is
+compared by content.  A stage that is rerun but leaves the same files
+behind therefore does not cause anything after it to be rebuilt.
+
+Manifests live in a ".metascons" directory at the top of the directory
+they describe, which is itself left out.  Next to each manifest is a
+".stat" file recording the size, time and inode of each file when its
+digest was computed.  Files whose stat data has not changed since the
+stage's last manifest, or since that of the stage before it in the
+same directory (eg, unpack for prepare), keep their digest so only
+new and changed files are read again.
+'''
+
+import os
+import json
+import stat
+import hashlib
+
+metadir = '.metascons'
+
+def manifest_path(root, stage):
+    'Return the path of the manifest of the stage describing root'
+    return os.path.join(root, metadir, stage + '.manifest')
+
+def file_digest(path):
+    'Return the hex SHA-1 digest of the file content'
+    hasher = hashlib.sha1()
+    fp = open(path, 'rb')
+    try:
+        while True:
+            data = fp.read(1<<16)
+            if not data: break
+            hasher.update(data)
+            continue
+    finally:
+        fp.close()
+    return hasher.hexdigest()
+
+def load_stat(path):
+    'Return the stat data saved with a manifest, if any'
+    try:
+        return json.load(open(path + '.stat'))
+    except (IOError, ValueError):
+        return {}
+
+def scan(root, known=None, exclude=()):
+    '''
+    Return a dictionary mapping the relative path of each file and
+    symlink under root to a list of size, mtime, inode, mode and
+    digest.  Entries in known with the same size, mtime and inode keep
+    their digest without the file being read.  Relative paths in
+    exclude are left out.
+    '''
+    known = known or {}
+    exclude = set(exclude)
+    ret = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        if rel == '.':
+            rel = ''
+            if metadir in dirnames:
+                dirnames.remove(metadir)
+            pass
+        for fname in filenames + [d for d in dirnames \
+                                      if os.path.islink(os.path.join(dirpath, d))]:
+            relpath = os.path.join(rel, fname)
+            if relpath in exclude: continue
+            path = os.path.join(dirpath, fname)
+            st = os.lstat(path)
+            info = [st.st_size, repr(st.st_mtime), st.st_ino,
+                    stat.S_IMODE(st.st_mode)]
+            old = known.get(relpath)
+            if old and old[:4] == info:
+                ret[relpath] = old
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                digest = 'link:' + os.readlink(path)
+            else:
+                digest = file_digest(path)
+            ret[relpath] = info + [digest]
+            continue
+        continue
+    return ret
+
+def write(root, path, exclude=(), previous=None):
+    '''
+    Write the manifest of root to path, reusing the digests of files
+    unchanged since the last time or since the manifest at previous
+    was written.  Return the number of files.
+    '''
+    known = previous and load_stat(previous) or {}
+    known.update(load_stat(path))
+    files = scan(root, known, exclude)
+    lines = ['%s %d %o %s\n' % (info[4], info[0], info[3], relpath) \
+                 for relpath,info in sorted(files.iteritems())]
+    fp = open(path, 'w')
+    fp.write(''.join(lines))
+    fp.close()
+    tmp = path + '.stat.tmp'
+    fp = open(tmp, 'w')
+    json.dump(files, fp)
+    fp.close()
+    os.rename(tmp, path + '.stat')
+    return len(lines)
+
+class ManifestAction(object):
+    '''
+    A SCons function action writing the manifest of a directory after
+    a stage, leaving out the given stage target files and reusing the
+    digests of any previous manifest of the directory.
+    '''
+    def __init__(self, root, path, exclude=(), previous=None):
+        self.root = root
+        self.path = path
+        self.previous = previous
+        self.exclude = [os.path.relpath(p, root) for p in exclude \
+                            if p.startswith(root.rstrip('/') + '/')]
+        return
+
+    def __call__(self, target, source, env):
+        write(self.root, self.path, self.exclude, self.previous)
+        return
+
+    def strfunction(self, target, source, env):
+        return None             # part of the stage, not worth a line
+
+    def get_contents(self, target, source, env):
+        return 'manifest %s %s' % (self.root, ' '.join(sorted(self.exclude)))
+
+    pass
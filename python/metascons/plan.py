@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+'''
+Build planning
+==============
+
+The wall time of each stage of each package is kept in a history file
+(JSON, by default BUILD_AREA/.metascons/stage-history.json) updated
+from the stages run by each build, as a moving average so it follows
+new versions.  Stages are timed by a metascons.trace Tracer.
+
+A Plan is the graph of the stages to run, each package's stages in
+order, a package's prepare after the install of its dependencies, its
+environment after theirs and a variant's copy of the source after
+the shared unpack (see metascons.variant), with the expected duration
+of each from the history.  Stages never run before are expected to
+take the median time of the same stage of other packages.  From this it gives:
+
+critical path
+
+  the chain of stages taking longest, which no number of jobs can
+  finish sooner than,
+
+makespan
+
+  the expected wall time of the build with a number of jobs, found by
+  simulating a scheduler that starts the ready stage with the most
+  work after it first and
+
+priorities
+
+  that remaining work for each package, used by the jobserver to
+  serve packages heading long chains first and to order the default
+  targets so SCons starts them first.
+'''
+
+import os
+import sys
+import json
+import heapq
+import atexit
+
+class History(object):
+    '''
+    Average wall seconds of package stages kept in the file at path.
+    '''
+    weight = 0.5                # of a new run in the average
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.stages = json.load(open(path))
+        except (IOError, ValueError):
+            self.stages = {}
+        return
+
+    def key(self, pname, stage):
+        return '%s %s' % (pname, stage)
+
+    def duration(self, pname, stage):
+        'Return the expected seconds of the stage or None if never run'
+        rec = self.stages.get(self.key(pname, stage))
+        return rec and rec['wall']
+
+    def add(self, pname, stage, seconds):
+        'Add a run of the stage taking seconds'
+        rec = self.stages.setdefault(self.key(pname, stage), {'wall': seconds, 'runs': 0})
+        rec['wall'] += self.weight * (seconds - rec['wall'])
+        rec['runs'] += 1
+        return
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        tmp = '%s.tmp%d' % (self.path, os.getpid())
+        json.dump(self.stages, open(tmp,'w'), indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+        return
+
+    def watch(self, tracer):
+        'Add the successful stages recorded by the tracer at exit'
+        def done():
+            recs = [r for r in tracer.records if r['status'] == 0]
+            for rec in recs:
+                self.add(rec['package'], rec['stage'], rec['wall'])
+                continue
+            if recs:
+                self.save()
+            return
+        atexit.register(done)
+        return
+
+    pass
+
+def median(values):
+    values = sorted(values)
+    if not values: return None
+    return values[len(values)//2]
+
+class Plan(object):
+    '''
+    The graph of stages given by chains, a dictionary of package name
+    to its list of stages, and deps, one of package name to the names
+    of its dependencies, with durations from the History if any.
+    '''
+    default = 1.0               # seconds of a stage never seen at all
+
+    def __init__(self, chains, deps, history):
+        self.chains = chains
+        self.preds = {}
+        self.succs = {}
+        for pname, stages in chains.iteritems():
+            for ind, stage in enumerate(stages):
+                node = (pname, stage)
+                self.preds.setdefault(node, [])
+                self.succs.setdefault(node, [])
+                if ind:
+                    self.edge((pname, stages[ind-1]), node)
+                continue
+            continue
+        for pname, stages in chains.iteritems():
+            for dep in deps.get(pname, []):
+                other = chains.get(dep, [])
+                if 'install' in other and 'prepare' in stages:
+                    self.edge((dep,'install'), (pname,'prepare'))
+                elif other[-1:] == ['unpack'] and stages[:1] == ['unpack']:
+                    self.edge((dep,'unpack'), (pname,'unpack'))     # variant copy
+                if 'environment' in other and 'environment' in stages:
+                    self.edge((dep,'environment'), (pname,'environment'))
+                continue
+            continue
+
+        self.durations = {}
+        self.estimated = set()
+        bystage = {}
+        for node in self.preds:
+            seconds = history and history.duration(*node)
+            if seconds is None:
+                self.estimated.add(node)
+                continue
+            self.durations[node] = seconds
+            bystage.setdefault(node[1], []).append(seconds)
+            continue
+        for node in self.estimated:
+            seconds = median(bystage.get(node[1], []))
+            if seconds is None:
+                seconds = self.default
+            self.durations[node] = seconds
+            continue
+
+        self.levels = self.bottom_levels()
+        return
+
+    def edge(self, a, b):
+        self.succs[a].append(b)
+        self.preds[b].append(a)
+        return
+
+    def order(self):
+        'Return the nodes in an order where each follows its predecessors'
+        count = dict([(node, len(p)) for node, p in self.preds.iteritems()])
+        ready = sorted([node for node, n in count.iteritems() if not n])
+        ret = []
+        while ready:
+            node = ready.pop()
+            ret.append(node)
+            for succ in self.succs[node]:
+                count[succ] -= 1
+                if not count[succ]:
+                    ready.append(succ)
+                continue
+            continue
+        return ret
+
+    def bottom_levels(self):
+        '''
+        Return for each stage the seconds of the longest chain of stages
+        starting with it.
+        '''
+        levels = {}
+        for node in reversed(self.order()):
+            levels[node] = self.durations[node] + \
+                max([0] + [levels[succ] for succ in self.succs[node]])
+            continue
+        return levels
+
+    def critical_path(self):
+        'Return the list of stages of the longest chain'
+        if not self.levels: return []
+        node = max([n for n, p in self.preds.iteritems() if not p],
+                   key=lambda n: (self.levels[n], n))
+        path = [node]
+        while self.succs[node]:
+            node = max(self.succs[node], key=lambda n: (self.levels[n], n))
+            path.append(node)
+            continue
+        return path
+
+    def work(self):
+        'Return the seconds of all stages'
+        return sum(self.durations.values())
+
+    def makespan(self, jobs):
+        '''
+        Return the expected seconds to run the graph with jobs stages at
+        once, starting ready stages with most work after them first.
+        '''
+        count = dict([(node, len(p)) for node, p in self.preds.iteritems()])
+        ready = [(-self.levels[n], n) for n, c in count.iteritems() if not c]
+        heapq.heapify(ready)
+        running = []            # heap of (finish, node)
+        now = 0.0
+        while ready or running:
+            while ready and len(running) < jobs:
+                level, node = heapq.heappop(ready)
+                heapq.heappush(running, (now + self.durations[node], node))
+                continue
+            now, node = heapq.heappop(running)
+            for succ in self.succs[node]:
+                count[succ] -= 1
+                if not count[succ]:
+                    heapq.heappush(ready, (-self.levels[succ], succ))
+                continue
+            continue
+        return now
+
+    def priorities(self):
+        '''
+        Return a dictionary of the milliseconds of work on the longest
+        chain starting with each package, at least one.
+        '''
+        ret = {}
+        for pname, stages in self.chains.iteritems():
+            if not stages: continue
+            ret[pname] = max(1, int(1000 * self.levels[(pname, stages[0])]))
+            continue
+        return ret
+
+    def report(self, jobs, out=sys.stdout):
+        'Print the critical path, the makespan and the packages bounding it'
+        path = self.critical_path()
+        length = path and self.levels[path[0]] or 0.0
+        out.write('\nbuild plan: %d stages of %d packages, %d without history\n' % \
+                      (len(self.durations), len(self.chains), len(self.estimated)))
+        out.write('  total work      %10.1f s\n' % self.work())
+        out.write('  critical path   %10.1f s\n' % length)
+        out.write('  makespan -j %-3d %10.1f s\n' % (jobs, self.makespan(jobs)))
+        if not path: return
+        bypkg = []
+        for node in path:
+            if bypkg and bypkg[-1][0] == node[0]:
+                bypkg[-1][1].append(node[1])
+                bypkg[-1][2] += self.durations[node]
+            else:
+                bypkg.append([node[0], [node[1]], self.durations[node]])
+            continue
+        out.write('  bounded by:\n')
+        for pname, stages, seconds in bypkg:
+            out.write('    %-20s %10.1f s %5.1f%%  %s\n' % \
+                          (pname, seconds, 100.0 * seconds / (length or 1),
+                           ' '.join(stages)))
+            continue
+        return
+
+    pass
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+'''
+Stage pools and prefetching
+===========================
+
+Under "scons -j N" every stage takes one of the same N slots, so
+downloads waiting on the network, unpacks waiting on the disk and
+compiles all hold each other up.  Here stages are put in classes:
+
+  download   the download stage
+
+  unpack     the unpack stage, and a variant's copy of the source
+
+  compute    the prepare and build stages
+
+  install    the install stage
+
+The "stage_jobs" item (eg, "download=8,unpack=2,compute=6") limits how
+many stages of a class run at once, on top of -j.  A class not given
+is only limited by -j, except downloads and unpacks which default to
+"download_jobs" (4) and 2.
+
+Unless "prefetch" is "no", the download and unpack stages of all
+packages that are out of date are also started right away by threads
+of their own, as many as their class allows, in the order of the build
+plan (see metascons.plan) rather than when SCons reaches them.  They
+run while earlier packages are still building and so take no -j
+slots.  When SCons gets to such a stage it waits for, or just takes,
+the result of the prefetch instead of running it again, so a package
+can be prepared as soon as its dependencies are installed.  A stage
+SCons reaches before it was started is run by SCons as usual.  At exit
+stages not yet started are dropped and running ones waited for.
+
+There is no prefetching with -n, --daemon or when targets are given
+on the command line, as then not all stages are meant to be run.
+'''
+
+import os
+import sys
+import heapq
+import atexit
+import threading
+
+classes = {'download': 'download', 'unpack': 'unpack', 'prepare': 'compute',
+           'build': 'compute', 'install': 'install'}
+
+def parse_limits(text):
+    '''
+    Return a dictionary of stage class to limit from text like
+    "download=8,unpack=2".
+    '''
+    ret = {}
+    for item in text.replace(',',' ').split():
+        cls, num = item.split('=',1)
+        assert cls in classes.values(), \
+            'Unknown stage class "%s" in "%s"' % (cls, text)
+        ret[cls] = int(num)
+        continue
+    return ret
+
+class Limiter(object):
+    '''
+    Limit the number of stages of each class running at once to that
+    given in limits, a dictionary of class to number.
+    '''
+    def __init__(self, limits):
+        self.limits = limits
+        self.slots = dict([(cls, threading.BoundedSemaphore(num)) \
+                               for cls, num in limits.iteritems() if num > 0])
+        return
+
+    def wrap(self, stage, action):
+        '''
+        Return a LimitedAction running action in its class, or action
+        if the stage is in none.  Stages are wrapped even if their
+        class is not limited so limits do not change their signature.
+        '''
+        if stage not in classes:
+            return action
+        return LimitedAction(self.slots.get(classes[stage]), action)
+
+    pass
+
+class LimitedAction(object):
+    '''
+    A SCons function action which holds a slot of its stage class, if
+    limited (slots is not None), while it runs the wrapped action.
+    '''
+    def __init__(self, slots, action):
+        from metascons.actions import scons_action
+        self.slots = slots
+        self.action = scons_action(action)
+        return
+
+    def __call__(self, target, source, env):
+        if self.slots is None:
+            return self.action(target, source, env, show=0)
+        with self.slots:
+            return self.action(target, source, env, show=0)
+
+    def strfunction(self, target, source, env):
+        'Show the wrapped action instead of this wrapper'
+        try:
+            return self.action.strfunction(target, source, env)
+        except AttributeError:
+            return self.action.genstring(target, source, env)
+
+    def get_contents(self, target, source, env):
+        'Let SCons sign the wrapped action instead of this wrapper'
+        return self.action.get_contents(target, source, env)
+
+    pass
+
+class Job(object):
+    'A stage that may be prefetched'
+    def __init__(self, key, action, nodes, after):
+        self.key = key          # (package, stage)
+        self.action = action
+        self.nodes = nodes
+        self.after = after      # keys of jobs to finish first
+        self.state = 'idle'     # queued, running, done or claimed
+        self.status = None
+        self.exc_info = None
+        self.done = threading.Event()
+        return
+
+    pass
+
+class Prefetcher(object):
+    '''
+    Run the download and unpack stages added to it in the background
+    with threads per class as given by limits.  Until started, or if
+    never, SCons runs them all as usual.
+    '''
+    def __init__(self, limits):
+        self.limits = limits
+        self.jobs = {}
+        self.cond = threading.Condition()
+        self.queues = dict([(cls, []) for cls in ['download','unpack']])
+        self.priorities = {}
+        self.stopped = False
+        self.count = 0
+        self.threads = []
+        return
+
+    def add(self, pname, stage, action, nodes, after=()):
+        '''
+        Add the stage of the package made by action with the SCons
+        target nodes, to run after the stages keyed in after.  Return
+        a PrefetchAction to give SCons in place of action.  The nodes
+        are made precious so SCons does not remove what was prefetched
+        before taking it.
+        '''
+        from metascons.actions import scons_action
+        key = (pname, stage)
+        action = scons_action(action)
+        for node in nodes:
+            node.set_precious()
+            continue
+        self.jobs[key] = Job(key, action, nodes, list(after))
+        return PrefetchAction(self, key, action)
+
+    def out_of_date(self):
+        '''
+        Return the keys of the jobs with a target SCons would remake
+        or after one that is.
+        '''
+        stale = set()
+        seen = set()
+        def visit(key):
+            if key in seen: return
+            seen.add(key)
+            job = self.jobs[key]
+            after = [k for k in job.after if k in self.jobs]
+            for other in after:
+                visit(other)
+                continue
+            if [k for k in after if k in stale]:
+                stale.add(key)
+                return
+            for node in job.nodes:
+                node.scan()
+                if not node.is_up_to_date():
+                    stale.add(key)
+                    break
+                continue
+            return
+        for key in self.jobs:
+            visit(key)
+            continue
+        for job in self.jobs.itervalues():
+            for node in job.nodes:
+                node.clear()    # let SCons look again when building
+                continue
+            continue
+        return stale
+
+    def start(self, priorities=None):
+        '''
+        Start prefetching the out of date stages, those of packages of
+        higher priority first.
+        '''
+        self.priorities = priorities or {}
+        stale = self.out_of_date()
+        for key, job in self.jobs.iteritems():
+            if key not in stale:
+                job.state = 'claimed'   # SCons will not run it
+                job.done.set()
+            continue
+        if not stale: return
+        print 'Prefetching %d download and unpack stages' % len(stale)
+        with self.cond:
+            for key in stale:
+                self.ready(self.jobs[key])
+                continue
+            pass
+        for cls, queue in self.queues.iteritems():
+            for ind in range(self.limits.get(cls) or 1):
+                thread = threading.Thread(target=self.worker, args=(cls,))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+                continue
+            continue
+        atexit.register(self.stop)
+        return
+
+    def ready(self, job):
+        'Queue the job if it is idle and what it is after is done'
+        if job.state != 'idle': return
+        for key in job.after:
+            other = self.jobs.get(key)
+            if other and not other.done.is_set(): return
+            continue
+        job.state = 'queued'
+        self.count += 1
+        heapq.heappush(self.queues[classes[job.key[1]]],
+                       (-self.priorities.get(job.key[0],0), self.count, job))
+        self.cond.notify_all()
+        return
+
+    def finish(self, job, stat, exc_info=None):
+        '''
+        Record the end of the job, with what its action returned, and
+        queue the jobs after it.
+        '''
+        with self.cond:
+            if job.state == 'running':
+                job.state = 'done'
+            job.status = stat
+            job.exc_info = exc_info
+            job.done.set()
+            if getattr(stat, 'status', stat) or exc_info:
+                return          # SCons reports it when it gets there
+            for other in self.jobs.itervalues():
+                if job.key in other.after:
+                    self.ready(other)
+                continue
+            self.cond.notify_all()
+        return
+
+    def worker(self, cls):
+        queue = self.queues[cls]
+        while True:
+            with self.cond:
+                while not queue and not self.stopped:
+                    self.cond.wait(1.0)
+                if self.stopped: return
+                job = heapq.heappop(queue)[2]
+                if job.state != 'queued': continue
+                job.state = 'running'
+            self.run(job)
+            continue
+
+    def run(self, job):
+        'Run the stage of the job as SCons would'
+        executor = job.nodes[0].get_executor()
+        try:
+            for node in job.nodes:      # as SCons does before a build
+                if not os.path.isdir(node.dir.abspath):
+                    os.makedirs(node.dir.abspath)
+                continue
+            stat = job.action(executor.get_all_targets(), executor.get_all_sources(),
+                              executor.get_build_env())
+        except Exception:
+            self.finish(job, 1, sys.exc_info())
+            return
+        self.finish(job, stat)
+        return
+
+    def claim(self, key):
+        '''
+        Return the job of the key if it was prefetched or is being,
+        otherwise mark it to be run by the caller and return None.
+        '''
+        with self.cond:
+            job = self.jobs[key]
+            if job.state in ['running','done']:
+                return job
+            job.state = 'claimed'
+        return None
+
+    def stop(self):
+        'Start no more jobs and wait for those running'
+        with self.cond:
+            self.stopped = True
+            running = [job for job in self.jobs.itervalues() if job.state == 'running']
+            self.cond.notify_all()
+        if running:
+            print 'Waiting for %d prefetched stages to finish' % len(running)
+        for thread in self.threads:
+            thread.join()
+            continue
+        return
+
+    pass
+
+class PrefetchAction(object):
+    '''
+    A SCons function action taking the result of a prefetched stage,
+    waiting for it if needed, or else running the stage.
+    '''
+    def __init__(self, prefetcher, key, action):
+        self.prefetcher = prefetcher
+        self.key = key
+        self.action = action
+        return
+
+    def __call__(self, target, source, env):
+        job = self.prefetcher.claim(self.key)
+        if job is None:
+            job = self.prefetcher.jobs[self.key]
+            try:
+                stat = self.action(target, source, env)
+            except Exception:
+                self.prefetcher.finish(job, 1, sys.exc_info())
+                raise
+            self.prefetcher.finish(job, stat)
+            return stat
+        job.done.wait()
+        if job.exc_info:
+            raise job.exc_info[0], job.exc_info[1], job.exc_info[2]
+        return job.status
+
+    def strfunction(self, target, source, env):
+        'The wrapped action shows itself if it is run here'
+        return None
+
+    def get_contents(self, target, source, env):
+        'Let SCons sign the wrapped action instead of this wrapper'
+        return self.action.get_contents(target, source, env)
+
+    pass
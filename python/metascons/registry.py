@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''
+Wrapper registry
+================
+
+The wrapper modules available to a build are found by listing the
+metascons.wrapper package directory and any extra plugin directories
+without importing them.  A wrapper module is only imported when its
+package is actually requested (directly or as a dependency).
+
+Plugin directories are added to the search path of the
+metascons.wrapper package itself so a plugin module is imported as
+metascons.wrapper.NAME just like a built-in one, its name() comes out
+the same and it can import other wrappers the usual way.
+
+A package built in a variant (see metascons.variant), NAME@VARIANT,
+gets its own copy of the wrapper of NAME.
+
+The values returned by a wrapper's methods describing the package
+(name, version, tarballpath, stage targets, etc) do not change during
+a run.  The registry remembers them so they are computed once per
+package no matter how often the build asks.
+'''
+
+import os
+import sys
+import copy
+import pkgutil
+import importlib
+
+import metascons.wrapper
+
+class Registry(object):
+    '''
+    The wrapper modules available for a build and the wrappers
+    imported so far.
+    '''
+    def __init__(self, paths=None):
+        self.package = metascons.wrapper
+        for path in paths or []:
+            path = os.path.abspath(path)
+            if path not in self.package.__path__:
+                self.package.__path__.append(path)
+            continue
+        self._names = None
+        self.wrappers = {}
+        self.memo = {}
+        return
+
+    def names(self):
+        'Return the sorted names of all available wrapper modules'
+        if self._names is None:
+            names = set()
+            for loader, name, ispkg in pkgutil.iter_modules(self.package.__path__):
+                names.add(name)
+                continue
+            self._names = sorted(names)
+        return self._names
+
+    def has(self, pname):
+        pname = pname.split('@')[0]
+        return pname in self.wrappers or pname in self.names()
+
+    def wrapper(self, pname):
+        'Return the wrapper object for the package, importing it if needed'
+        try:
+            return self.wrappers[pname]
+        except KeyError:
+            pass
+        if not self.has(pname):
+            raise ImportError('No wrapper module for package "%s" in %s' % \
+                                  (pname, ':'.join(self.package.__path__)))
+        if '@' in pname:
+            pobj = copy.copy(self.wrapper(pname.split('@')[0]))
+            self.wrappers[pname] = pobj
+            return pobj
+        pmod = importlib.import_module(self.package.__name__ + '.' + pname)
+        pobj = pmod.wrapper
+        self.wrappers[pname] = pobj
+        return pobj
+
+    def attribute(self, pname, what):
+        '''
+        Return the value of calling the wrapper's method named what,
+        computing it only on first request.  Only use this for methods
+        whose value is fixed once the wrapper's environment is set.
+        '''
+        key = (pname, what)
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        val = getattr(self.wrapper(pname), what)()
+        self.memo[key] = val
+        return val
+
+    def files(self):
+        'Return the source files of the wrapper modules imported so far'
+        ret = []
+        for pname in self.wrappers:
+            if '@' in pname: continue
+            mod = sys.modules.get(self.package.__name__ + '.' + pname)
+            path = getattr(mod, '__file__', None)
+            if not path: continue
+            if path.endswith('.pyc') or path.endswith('.pyo'):
+                path = path[:-1]
+            ret.append(os.path.abspath(path))
+            continue
+        return ret
+
+    pass
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+'''
+Recipe stanzas
+==============
+
+Reads the stanza files described in mc2.org.  An action stanza names
+an action, a package and an optional version constraint:
+
+  [configure root %(version)s < 6]
+  creates = config.status
+  command = cd %(sourcedir)s && ./configure --prefix=%(installdir)s
+
+  [configure root 6 <= %(version)s < 6.10 or %(version)s == 6.10.02]
+  ...
+
+A constraint is one or more comparisons of "%(version)s" (or just
+"version") with literal versions, chained as in Python, joined with
+"and" and "or".  The "creates" key is the stage's target file relative
+to where the stage writes and "command" its SCons command action.
+Both are interpolated with the package's name, version and directories
+and the suite's name and tags.
+
+A suite stanza gives package versions and asserts tags:
+
+  [suite hepsoft debug release1.0]
+  root = 5.34.36
+
+Stanzas are indexed by action and package, each in an interval tree
+over its version constraints, so finding the stanzas that apply to a
+version takes logarithmic time however many variants there are.  If
+several apply the most specific wins: an exact version over a range
+closed on both sides over one open on a side over no constraint, and
+then a range inside the others.  Otherwise the choice is ambiguous
+and an error.
+
+Versions are compared component by component, splitting at ".", "-",
+"_", "/" and between digits and letters.  Numbers compare as numbers,
+zeros ending a run of numbers are ignored and pre-release words (dev,
+alpha, beta, pre, rc and their one letter forms) sort before the
+release.  A package whose versions mean something else can have its
+own key function added with register_scheme().
+'''
+
+import re
+import ConfigParser
+
+prerelease = {'dev': 0, 'a': 1, 'alpha': 1, 'b': 2, 'beta': 2,
+              'pre': 3, 'c': 4, 'rc': 4}
+
+NUMBER, WORD, END, PRE = 3, 2, 1, 0
+
+def default_key(version):
+    'Return the sort key of a version string'
+    parts = []
+    for tok in re.findall(r'\d+|[A-Za-z]+', version):
+        if tok.isdigit():
+            parts.append((NUMBER, int(tok)))
+        elif tok.lower() in prerelease:
+            parts.append((PRE, prerelease[tok.lower()]))
+        else:
+            parts.append((WORD, tok.lower()))
+        continue
+    # drop zeros ending a run of numbers so 1.0 == 1 and 1.0rc1 < 1.0
+    ret = []
+    for part in parts + [(END, '')]:
+        if part[0] != NUMBER:
+            while ret and ret[-1] == (NUMBER, 0):
+                ret.pop()
+        ret.append(part)
+        continue
+    return tuple(ret)
+
+def letters_post_key(version):
+    '''
+    Return the sort key of a version string whose letters mark later
+    releases, eg openssl's 1.0.2a after 1.0.2.
+    '''
+    parts = []
+    for part in default_key(version):
+        if part[0] == PRE:
+            part = (WORD, [k for k,v in prerelease.items() if v == part[1]][0])
+        parts.append(part)
+        continue
+    return tuple(parts)
+
+schemes = {}
+
+def register_scheme(package, keyfunc):
+    'Compare the versions of the package with keyfunc'
+    schemes[package] = keyfunc
+    return
+
+def version_key(version, package=None):
+    'Return the sort key of the version of the package'
+    return schemes.get(package, default_key)(version)
+
+def compare_versions(a, b, package=None):
+    'Compare two versions of a package like cmp()'
+    return cmp(version_key(a, package), version_key(b, package))
+
+LOW = ()                  # below every version key
+HIGH = ((NUMBER + 1,),)   # above every version key
+
+class Interval(object):
+    '''
+    A range of version keys, each end included or not, holding the
+    stanza it applies to.
+    '''
+    def __init__(self, lo=LOW, lo_incl=False, hi=HIGH, hi_incl=False, stanza=None):
+        self.lo, self.lo_incl, self.hi, self.hi_incl = lo, lo_incl, hi, hi_incl
+        self.stanza = stanza
+        return
+
+    def contains(self, key):
+        if key < self.lo or (key == self.lo and not self.lo_incl): return False
+        if key > self.hi or (key == self.hi and not self.hi_incl): return False
+        return True
+
+    def intersect(self, other):
+        'Return the intersection with another interval'
+        ret = Interval(self.lo, self.lo_incl, self.hi, self.hi_incl, self.stanza)
+        if other.lo > ret.lo or (other.lo == ret.lo and not other.lo_incl):
+            ret.lo, ret.lo_incl = other.lo, other.lo_incl
+        if other.hi < ret.hi or (other.hi == ret.hi and not other.hi_incl):
+            ret.hi, ret.hi_incl = other.hi, other.hi_incl
+        return ret
+
+    def inside(self, other):
+        'Return True if this interval lies within the other'
+        return other.intersect(self).bounds() == self.bounds()
+
+    def bounds(self):
+        return (self.lo, self.lo_incl, self.hi, self.hi_incl)
+
+    def rank(self):
+        'Return how specific the interval is, higher is more'
+        if self.lo == self.hi: return 3
+        return (self.lo != LOW) + (self.hi != HIGH)
+
+    pass
+
+class IntervalTree(object):
+    '''
+    A static centered interval tree answering which intervals contain
+    a key.
+    '''
+    def __init__(self, intervals):
+        self.center = None
+        if not intervals: return
+        ends = sorted([i.lo for i in intervals if i.lo != LOW] + \
+                          [i.hi for i in intervals if i.hi != HIGH])
+        self.center = ends and ends[len(ends)//2] or LOW
+        left, right, here = [], [], []
+        for ival in intervals:
+            if ival.hi < self.center:
+                left.append(ival)
+            elif ival.lo > self.center:
+                right.append(ival)
+            else:
+                here.append(ival)
+            continue
+        self.by_lo = sorted(here, key=lambda i: i.lo)
+        self.by_hi = sorted(here, key=lambda i: i.hi, reverse=True)
+        self.left = left and IntervalTree(left) or None
+        self.right = right and IntervalTree(right) or None
+        return
+
+    def stab(self, key):
+        'Return the intervals containing key'
+        ret = []
+        node = self
+        while node and node.center is not None:
+            if key < node.center:
+                for ival in node.by_lo:
+                    if ival.lo > key: break
+                    if ival.contains(key): ret.append(ival)
+                    continue
+                node = node.left
+            elif key > node.center:
+                for ival in node.by_hi:
+                    if ival.hi < key: break
+                    if ival.contains(key): ret.append(ival)
+                    continue
+                node = node.right
+            else:
+                ret += [i for i in node.by_lo if i.contains(key)]
+                break
+            continue
+        return ret
+
+    pass
+
+def parse_constraint(text, package=None):
+    '''
+    Return the list of Intervals of the versions of the package
+    meeting the constraint, any of which meets it.
+    '''
+    text = text.replace('%(version)s', ' version ')
+    text = re.sub(r'(<=|>=|==|!=|<|>|=)', r' \1 ', text)
+    words = text.split()
+    if not words:
+        return [Interval()]
+    ret = []
+    for conj in ' '.join(words).split(' or '):
+        ival = Interval()
+        for chain in conj.split(' and '):
+            toks = chain.split()
+            if len(toks) < 3 or len(toks) % 2 == 0:
+                raise ValueError('Bad version constraint: "%s"' % text.strip())
+            for ind in range(0, len(toks) - 2, 2):
+                ival = ival.intersect(comparison(toks[ind], toks[ind+1],
+                                                 toks[ind+2], package))
+                continue
+            continue
+        if ival.lo < ival.hi or (ival.lo == ival.hi and ival.lo_incl and ival.hi_incl):
+            ret.append(ival)
+        continue
+    return ret
+
+def comparison(left, op, right, package):
+    'Return the Interval for one comparison of the version with a literal'
+    flip = {'<': '>', '<=': '>=', '>': '<', '>=': '<=', '==': '==', '=': '=='}
+    if op not in flip:
+        raise ValueError('Unsupported version comparison "%s"' % op)
+    if left == 'version' and right != 'version':
+        key = version_key(right, package)
+    elif right == 'version' and left != 'version':
+        key = version_key(left, package)
+        op = flip[op]
+    else:
+        raise ValueError('Comparison must be of the version with a literal: %s %s %s' \
+                             % (left, op, right))
+    if op in ['==','=']:
+        return Interval(key, True, key, True)
+    if op == '<':
+        return Interval(hi=key)
+    if op == '<=':
+        return Interval(hi=key, hi_incl=True)
+    if op == '>':
+        return Interval(lo=key)
+    return Interval(lo=key, lo_incl=True)
+
+class Stanza(object):
+    'An action stanza, its items not yet interpolated'
+    def __init__(self, action, package, constraint, items):
+        self.action = action
+        self.package = package
+        self.constraint = constraint
+        self.items = items
+        return
+
+    def name(self):
+        return ' '.join([self.action, self.package, self.constraint]).strip()
+
+    def get(self, item, values):
+        'Return the item interpolated with the dictionary of values'
+        return self.items[item] % values
+
+    pass
+
+class Suite(object):
+    'A suite stanza: its name, tags and package versions'
+    def __init__(self, name, tags, versions):
+        self.name = name
+        self.tags = tags
+        self.versions = versions
+        return
+
+    pass
+
+class AmbiguousRecipe(ValueError):
+    pass
+
+class Index(object):
+    '''
+    Stanzas read from files, indexed by action and package.
+    '''
+    def __init__(self, paths=()):
+        self.stanzas = {}       # (action, package) -> [Interval]
+        self.trees = {}         # (action, package) -> IntervalTree
+        self.suites = {}
+        for path in paths:
+            self.read(path)
+            continue
+        return
+
+    def read(self, path):
+        'Add the stanzas of the file'
+        cfg = ConfigParser.RawConfigParser()
+        cfg.optionxform = str
+        if not cfg.read(path):
+            raise IOError('Can not read recipe file "%s"' % path)
+        for section in cfg.sections():
+            items = dict(cfg.items(section))
+            words = section.split(None, 2)
+            if words[0] == 'suite':
+                tags = section.split()[2:]
+                self.suites[words[1]] = Suite(words[1], tags, items)
+                continue
+            if len(words) < 2:
+                raise ValueError('Stanza needs an action and a package: [%s]' % section)
+            constraint = len(words) > 2 and words[2] or ''
+            self.add(Stanza(words[0], words[1], constraint, items))
+            continue
+        return
+
+    def add(self, stanza):
+        key = (stanza.action, stanza.package)
+        for ival in parse_constraint(stanza.constraint, stanza.package):
+            ival.stanza = stanza
+            self.stanzas.setdefault(key, []).append(ival)
+            continue
+        self.trees.pop(key, None)
+        return
+
+    def tree(self, action, package):
+        key = (action, package)
+        tree = self.trees.get(key)
+        if tree is None:
+            tree = self.trees[key] = IntervalTree(self.stanzas.get(key, []))
+        return tree
+
+    def resolve(self, action, package, version):
+        '''
+        Return the stanza of the action which applies to the version of
+        the package or None.
+        '''
+        if (action, package) not in self.stanzas: return None
+        found = {}              # a stanza may match through several intervals
+        for ival in self.tree(action, package).stab(version_key(version, package)):
+            old = found.get(ival.stanza)
+            if not old or ival.rank() > old.rank():
+                found[ival.stanza] = ival
+            continue
+        if not found: return None
+        found = found.values()
+        top = max(i.rank() for i in found)
+        best = [i for i in found if i.rank() == top]
+        for ival in best:
+            if not [o for o in best if not ival.inside(o)]:
+                return ival.stanza
+            continue
+        raise AmbiguousRecipe('Version %s of %s matches more than one "%s": %s' % \
+                                  (version, package, action,
+                                   ', '.join('[%s]' % i.stanza.name() for i in best)))
+
+    pass
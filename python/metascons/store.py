@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+'''
+Content-addressed file store
+============================
+
+Files are kept under ROOT/XX/YYYY... where XXYYYY... is the hex SHA-256
+digest of their contents.  Users of the store get hard links to these
+files so any number of directories (eg, the TAR_FILES of several
+suites) share one copy on disk.  If the store and the user's directory
+are on different filesystems the file is copied instead.
+'''
+
+import os
+import errno
+import shutil
+import hashlib
+
+blocksize = 1<<16
+
+def file_digest(path):
+    'Return the hex SHA-256 digest of the contents of the file at path'
+    hasher = hashlib.sha256()
+    fp = open(path,'rb')
+    try:
+        while True:
+            data = fp.read(blocksize)
+            if not data: break
+            hasher.update(data)
+            continue
+    finally:
+        fp.close()
+    return hasher.hexdigest()
+
+def link_or_copy(src, dst):
+    '''
+    Atomically make dst a hard link to src, falling back to a copy
+    across filesystems.
+    '''
+    tmp = '%s.tmp%d' % (dst, os.getpid())
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError, err:
+        if err.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+            raise
+        shutil.copy2(src, tmp)
+        pass
+    os.rename(tmp, dst)
+    return
+
+class ContentStore(object):
+    '''
+    A directory of files named by the SHA-256 digest of their content.
+    '''
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        return
+
+    def path(self, digest):
+        'Return the store path of the file with the given digest'
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def has(self, digest):
+        'Return True if the store holds a file with the given digest'
+        return os.path.exists(self.path(digest))
+
+    def same(self, digest, path):
+        '''
+        Cheaply check if path is already a link to the stored file
+        with the given digest.
+        '''
+        try:
+            return os.path.samefile(self.path(digest), path)
+        except OSError:
+            return False
+
+    def link(self, digest, path):
+        'Make path a link to the stored file with the given digest'
+        if self.same(digest, path):
+            return
+        link_or_copy(self.path(digest), path)
+        return
+
+    def add(self, path, digest=None):
+        '''
+        Add the file at path to the store, computing its digest if not
+        given.  If the store already holds the content, path is
+        replaced by a link to the stored copy.  Return the digest.
+        '''
+        if not digest:
+            digest = file_digest(path)
+        spath = self.path(digest)
+        if os.path.exists(spath):
+            self.link(digest, path)
+            return digest
+        sdir = os.path.dirname(spath)
+        if not os.path.isdir(sdir):
+            try:
+                os.makedirs(sdir)
+            except OSError, err:
+                if err.errno != errno.EEXIST: raise
+                pass
+            pass
+        link_or_copy(path, spath)
+        return digest
+
+    pass
+
+def tarball_store(env):
+    '''
+    Return the ContentStore named by TARBALL_STORE in the construction
+    environment env or None if no store is configured.
+    '''
+    root = env.get('TARBALL_STORE')
+    if not root: return None
+    return ContentStore(root)
+
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+'''
+Stage tracing
+=============
+
+With a Tracer every stage action of every package is wrapped so that
+when it runs it records:
+
+wall
+
+  the elapsed time,
+
+cpu
+
+  the user plus system CPU time of the thread running the stage and
+  of any commands it runs,
+
+maxrss
+
+  the largest peak resident set size of the commands it runs,
+
+downloaded
+
+  the bytes transferred by the built-in downloader and
+
+written
+
+  the bytes written by the built-in unpacker plus those the commands
+  wrote to disk.
+
+Commands are run with a SPAWN function that reaps them with wait4() to
+get their resource usage.  Code that moves data counts it against the
+stage running in the current thread with count().
+
+The records are written as a Chrome trace event file, which can be
+loaded in chrome://tracing or https://ui.perfetto.dev, and a summary
+table sorted by cost is printed when the build ends unless the
+tracer is quiet.
+'''
+
+import os
+import sys
+import errno
+import json
+import time
+import atexit
+import threading
+import subprocess
+
+local = threading.local()
+
+def count(what, nbytes):
+    'Add nbytes to the "what" total of the stage running in this thread'
+    rec = getattr(local, 'record', None)
+    if rec is None: return
+    rec[what] = rec.get(what,0) + nbytes
+    return
+
+def thread_cpu_function():
+    '''
+    Return a function giving the CPU seconds used by the calling thread
+    or None if this is not supported (it uses Linux RUSAGE_THREAD).
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        getrusage = libc.getrusage
+    except (ImportError, OSError, AttributeError):
+        return None
+    class timeval(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_usec', ctypes.c_long)]
+    class rusage(ctypes.Structure):
+        _fields_ = [('ru_utime', timeval), ('ru_stime', timeval)] + \
+            [('ru_%d' % n, ctypes.c_long) for n in range(14)]
+    RUSAGE_THREAD = 1
+    def cpu():
+        ru = rusage()
+        getrusage(RUSAGE_THREAD, ctypes.byref(ru))
+        return ru.ru_utime.tv_sec + ru.ru_stime.tv_sec + \
+            (ru.ru_utime.tv_usec + ru.ru_stime.tv_usec) * 1e-6
+    return cpu
+
+_thread_cpu = thread_cpu_function()
+
+def thread_cpu():
+    '''
+    Return the user plus system CPU seconds used by the calling thread,
+    or by the whole process where that is not available.
+    '''
+    if _thread_cpu:
+        return _thread_cpu()
+    t = os.times()
+    return t[0] + t[1]
+
+class Tracer(object):
+    '''
+    Collect the records of traced stages and write them out.
+    '''
+    columns = ['wall','cpu','maxrss','downloaded','written']
+
+    def __init__(self, path=None, quiet=False):
+        self.path = path
+        self.quiet = quiet
+        self.start = time.time()
+        self.records = []
+        self.lock = threading.Lock()
+        self.lanes = {}
+        atexit.register(self.finish)
+        return
+
+    def wrap(self, pname, stage, action):
+        'Return a TracedAction recording a run of action'
+        return TracedAction(self, pname, stage, action)
+
+    def lane(self):
+        'Return a small number naming the calling thread'
+        ident = threading.current_thread().ident
+        with self.lock:
+            return self.lanes.setdefault(ident, len(self.lanes))
+
+    def add(self, rec):
+        with self.lock:
+            self.records.append(rec)
+        return
+
+    def events(self):
+        'Return the records as Chrome trace events'
+        ret = []
+        for rec in self.records:
+            args = dict([(c,rec.get(c,0)) for c in self.columns])
+            args['status'] = rec['status']
+            ret.append({'name': '%s %s' % (rec['package'], rec['stage']),
+                        'cat': rec['stage'], 'ph': 'X', 'pid': 1,
+                        'tid': rec['lane'],
+                        'ts': int((rec['begin'] - self.start)*1e6),
+                        'dur': int(rec['wall']*1e6),
+                        'args': args})
+            continue
+        return ret
+
+    def write(self, path):
+        'Write the trace event file'
+        fp = open(path,'w')
+        json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, fp)
+        fp.close()
+        return
+
+    def summary(self, out=sys.stdout):
+        'Print a table of the records sorted by decreasing wall time'
+        if not self.records: return
+        recs = sorted(self.records, key=lambda r: -r['wall'])
+        fmt = '%-20s %-12s %9s %9s %10s %12s %12s\n'
+        out.write('\nstage trace summary:\n')
+        out.write(fmt % ('package','stage','wall(s)','cpu(s)','maxrss(kB)',
+                         'downloaded','written'))
+        tot = dict([(c,0) for c in self.columns])
+        for rec in recs:
+            out.write(fmt % (rec['package'], rec['stage'],
+                             '%.2f' % rec['wall'], '%.2f' % rec['cpu'],
+                             rec.get('maxrss',0), rec.get('downloaded',0),
+                             rec.get('written',0)))
+            for c in self.columns:
+                if c == 'maxrss':
+                    tot[c] = max(tot[c], rec.get(c,0))
+                else:
+                    tot[c] += rec.get(c,0)
+                continue
+            continue
+        out.write(fmt % ('total','','%.2f' % tot['wall'], '%.2f' % tot['cpu'],
+                         tot['maxrss'], tot['downloaded'], tot['written']))
+        return
+
+    def finish(self):
+        'Called at exit to write the trace file and summary'
+        if self.path:
+            self.write(self.path)
+        if not self.quiet:
+            self.summary()
+        return
+
+    pass
+
+class TracedAction(object):
+    '''
+    A SCons function action which runs the wrapped action and records
+    its cost with a Tracer.
+    '''
+    def __init__(self, tracer, pname, stage, action):
+        from metascons.actions import scons_action
+        self.tracer = tracer
+        self.pname = pname
+        self.stage = stage
+        self.action = scons_action(action)
+        return
+
+    def __call__(self, target, source, env):
+        rec = {'package': self.pname, 'stage': self.stage,
+               'lane': self.tracer.lane(), 'cpu': 0.0, 'maxrss': 0,
+               'status': 'exception'}
+        spawn = Spawner(rec, env['SPAWN'])
+        local.record = rec
+        cpu0 = thread_cpu()
+        rec['begin'] = time.time()
+        try:
+            tenv = env.Override({'SPAWN': spawn})
+            stat = self.action(target, source, tenv, show=0)
+            rec['status'] = getattr(stat, 'status', stat) or 0
+            return stat
+        finally:
+            rec['wall'] = time.time() - rec['begin']
+            rec['cpu'] += thread_cpu() - cpu0
+            local.record = None
+            self.tracer.add(rec)
+
+    def strfunction(self, target, source, env):
+        'Show the wrapped action instead of this wrapper'
+        try:
+            return self.action.strfunction(target, source, env)
+        except AttributeError:
+            return self.action.genstring(target, source, env)
+
+    def get_contents(self, target, source, env):
+        'Let SCons sign the wrapped action instead of this wrapper'
+        return self.action.get_contents(target, source, env)
+
+    pass
+
+class Spawner(object):
+    '''
+    A SCons SPAWN function adding the resource usage of the commands
+    it runs to a trace record.  Other SPAWN functions are left alone.
+    '''
+    def __init__(self, rec, spawn):
+        self.rec = rec
+        self.spawn = spawn
+        return
+
+    def __call__(self, sh, escape, cmd, args, env):
+        if getattr(self.spawn, '__name__', None) != 'subprocess_spawn':
+            return self.spawn(sh, escape, cmd, args, env)
+        proc = subprocess.Popen([sh, '-c', ' '.join(args)], env=env,
+                                close_fds=True)
+        while True:
+            try:
+                pid, status, ru = os.wait4(proc.pid, 0)
+                break
+            except OSError, err:
+                if err.errno != errno.EINTR: raise
+                pass
+            continue
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        rec = self.rec
+        rec['cpu'] += ru.ru_utime + ru.ru_stime
+        rec['maxrss'] = max(rec['maxrss'], ru.ru_maxrss)
+        rec['written'] = rec.get('written',0) + ru.ru_oublock * 512
+        return proc.returncode
+
+    pass
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+'''
+Built-in archive unpacker
+=========================
+
+This module unpacks source tarballs in-process instead of running tar
+or unzip.  The archive is decompressed as a stream by the calling
+thread while a small pool of threads creates the files, so reading
+the archive overlaps with the (often slow, eg on NFS) filesystem work.
+
+Supported are .tar, .tar.gz/.tgz, .tar.bz2/.tbz2, .tar.xz/.txz and
+.zip.  Decompressing xz needs the lzma (or backports.lzma) module or
+else the "xz" program.
+
+Leading path components can be stripped from the archive entries so a
+tarball that unpacks to, eg, "root/" can be unpacked straight into the
+expected source directory.
+
+Nothing is written outside of the destination directory: entries with
+".." in their names, symbolic links leading out of it and entries
+below a symbolic link are refused.  Entries for the same path are
+written by the same thread, in archive order, so the last one wins.
+'''
+
+import os
+import time
+import stat
+import Queue
+import collections
+import tarfile
+import zipfile
+import threading
+import subprocess
+
+from metascons import trace
+
+# files bigger than this are written by the reading thread instead of
+# being held in memory for the pool
+maxqueued = 1<<24
+blocksize = 1<<16
+
+threads = 4
+
+def configure(nthreads=None):
+    'Set the default number of threads creating files'
+    global threads
+    if nthreads:
+        threads = int(nthreads)
+    return threads
+
+def archive_type(path):
+    '''
+    Return (kind, compression) for the archive at path based on its
+    extension.  Kind is "tar" or "zip", compression is "gz", "bz2",
+    "xz" or "".
+    '''
+    name = path.lower()
+    if name.endswith('.zip'):
+        return 'zip',''
+    for exts,comp in [(['.tar.gz','.tgz'],'gz'),
+                      (['.tar.bz2','.tbz2','.tbz'],'bz2'),
+                      (['.tar.xz','.txz'],'xz')]:
+        for ext in exts:
+            if name.endswith(ext):
+                return 'tar',comp
+            continue
+        continue
+    return 'tar',''
+
+def stripped(name, strip):
+    '''
+    Return the relative path of an archive entry after removing strip
+    leading components or None if nothing is left.  Entries that would
+    land outside the destination are refused.
+    '''
+    parts = [p for p in name.split('/') if p and p != '.']
+    if '..' in parts:
+        raise IOError('Refusing to unpack "%s"' % name)
+    parts = parts[strip:]
+    if not parts: return None
+    return os.path.join(*parts)
+
+def check_link(name, rel, linkto, destdir):
+    '''
+    Refuse a symbolic link at the relative path rel to linkto unless
+    it leads to somewhere in destdir.
+    '''
+    if os.path.isabs(linkto):
+        target = os.path.relpath(os.path.normpath(linkto), os.path.abspath(destdir))
+    else:
+        target = os.path.normpath(os.path.join(os.path.dirname(rel), linkto))
+    if target == '..' or target.startswith('..' + os.sep):
+        raise IOError('Refusing to unpack "%s" linking to "%s"' % (name, linkto))
+    return
+
+def check_parents(name, rel, symlinks):
+    'Refuse an entry at the relative path rel below one of the symlinks'
+    parent = os.path.dirname(rel)
+    while parent:
+        if parent in symlinks:
+            raise IOError('Refusing to unpack "%s" below a link' % name)
+        parent = os.path.dirname(parent)
+        continue
+    return
+
+class Writer(object):
+    '''
+    A pool of threads creating files and symlinks.  Each path is given
+    to the same thread so its entries are written in order.
+    '''
+    def __init__(self, nthreads):
+        self.queues = [Queue.Queue(4) for count in range(nthreads)]
+        self.error = None
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.threads = []
+        for queue in self.queues:
+            thread = threading.Thread(target=self.work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            continue
+        return
+
+    def work(self, queue):
+        while True:
+            job = queue.get()
+            try:
+                if job is None: return
+                if self.error: continue
+                job[0](*job[1:])
+            except Exception, err:
+                self.error = err
+            finally:
+                queue.task_done()
+            continue
+
+    def queue(self, path):
+        'Return the queue of the thread writing the path'
+        return self.queues[hash(path) % len(self.queues)]
+
+    def put(self, *job):
+        'Queue a call of job[0] with the path job[1] and other arguments'
+        if self.error: raise self.error
+        self.queue(job[1]).put(job)
+        return
+
+    def flush(self, path):
+        'Wait for what was queued for the path to be written'
+        self.queue(path).join()
+        if self.error: raise self.error
+        return
+
+    def count(self, nbytes):
+        self.lock.acquire()
+        self.nbytes += nbytes
+        self.lock.release()
+        return
+
+    def write_file(self, path, data, mode, mtime):
+        if os.path.lexists(path):
+            os.remove(path)
+        fp = open(path,'wb')
+        try:
+            fp.write(data)
+        finally:
+            fp.close()
+        finish(path, mode, mtime)
+        self.count(len(data))
+        return
+
+    def symlink(self, path, linkto):
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(linkto, path)
+        return
+
+    def abort(self):
+        'Stop the threads, dropping any queued work'
+        if not self.error:
+            self.error = IOError('unpacking aborted')
+        for thread, queue in zip(self.threads, self.queues):
+            if thread.is_alive():
+                queue.put(None)
+            continue
+        return
+
+    def join(self):
+        'Wait for all queued work, raising any error it hit'
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error: raise self.error
+        return
+
+    pass
+
+def finish(path, mode, mtime):
+    'Apply permissions and modification time to a new file'
+    if mode is not None:
+        os.chmod(path, mode)
+    if mtime is not None:
+        os.utime(path, (mtime,mtime))
+    return
+
+def makedirs(path, made, top):
+    '''
+    Create directory path, remembering what exists in made.  Refuse
+    one that an existing link leads out of top, the real path of the
+    destination.
+    '''
+    if path in made: return
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    real = os.path.realpath(path)
+    if real != top and not real.startswith(top + os.sep):
+        raise IOError('Refusing to unpack into "%s" which leads out' % path)
+    made.add(path)
+    return
+
+def open_tar(path, comp):
+    '''
+    Return an open tarfile streaming from path and any helper process
+    decompressing it.
+    '''
+    if comp != 'xz':
+        return tarfile.open(path, 'r|' + (comp or '*')), None
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            lzma = None
+            pass
+        pass
+    if lzma:
+        return tarfile.open(fileobj=lzma.LZMAFile(path), mode='r|'), None
+    proc = subprocess.Popen(['xz','-dc',path], stdout=subprocess.PIPE)
+    return tarfile.open(fileobj=proc.stdout, mode='r|'), proc
+
+def unpack_tar(path, comp, destdir, strip, writer):
+    'Unpack a tar archive, return list of (dir,mode,mtime) to finish'
+    tar,proc = open_tar(path, comp)
+    top = os.path.realpath(destdir)
+    made = set()
+    dirs = []
+    links = collections.OrderedDict()   # hard links, last entry wins
+    symlinks = set()
+    try:
+        for member in tar:
+            rel = stripped(member.name, strip)
+            if not rel: continue
+            check_parents(member.name, rel, symlinks)
+            symlinks.discard(rel)
+            links.pop(rel, None)
+            out = os.path.join(destdir, rel)
+            if member.isdir():
+                makedirs(out, made, top)
+                dirs.append((out, member.mode, member.mtime))
+                continue
+            makedirs(os.path.dirname(out), made, top)
+            if member.issym():
+                check_link(member.name, rel, member.linkname, destdir)
+                symlinks.add(rel)
+                writer.put(writer.symlink, out, member.linkname)
+                continue
+            if member.islnk():
+                linkto = stripped(member.linkname, strip)
+                if linkto:
+                    check_parents(member.linkname, linkto, symlinks)
+                    links[rel] = linkto
+                continue
+            if not member.isfile():
+                continue        # devices, fifos
+            src = tar.extractfile(member)
+            if member.size > maxqueued:
+                # too big to hold, stream it here after earlier entries
+                writer.flush(out)
+                if os.path.lexists(out): os.remove(out)
+                fp = open(out,'wb')
+                while True:
+                    data = src.read(blocksize)
+                    if not data: break
+                    fp.write(data)
+                    continue
+                fp.close()
+                finish(out, member.mode, member.mtime)
+                writer.count(member.size)
+                continue
+            writer.put(writer.write_file, out, src.read(),
+                       member.mode, member.mtime)
+            continue
+    finally:
+        tar.close()
+        if proc:
+            proc.stdout.close()
+            if proc.wait():
+                raise IOError('xz failed to decompress %s' % path)
+            pass
+        pass
+    writer.join()
+
+    # hard links need their targets in place
+    for rel,linkto in links.iteritems():
+        out = os.path.join(destdir, rel)
+        if os.path.lexists(out): os.remove(out)
+        os.link(os.path.join(destdir, linkto), out)
+        continue
+    return dirs
+
+def unpack_zip(path, destdir, strip, writer):
+    'Unpack a zip archive, return list of (dir,mode,mtime) to finish'
+    zfp = zipfile.ZipFile(path)
+    top = os.path.realpath(destdir)
+    made = set()
+    dirs = []
+    symlinks = set()
+    try:
+        for info in zfp.infolist():
+            rel = stripped(info.filename, strip)
+            if not rel: continue
+            check_parents(info.filename, rel, symlinks)
+            symlinks.discard(rel)
+            out = os.path.join(destdir, rel)
+            mode = (info.external_attr >> 16) & 0xFFFF
+            mtime = time.mktime(info.date_time + (0,0,-1))
+            if info.filename.endswith('/'):
+                makedirs(out, made, top)
+                dirs.append((out, stat.S_IMODE(mode) or None, mtime))
+                continue
+            makedirs(os.path.dirname(out), made, top)
+            if stat.S_ISLNK(mode):
+                linkto = zfp.read(info)
+                check_link(info.filename, rel, linkto, destdir)
+                symlinks.add(rel)
+                writer.put(writer.symlink, out, linkto)
+                continue
+            writer.put(writer.write_file, out, zfp.read(info),
+                       stat.S_IMODE(mode) or None, mtime)
+            continue
+    finally:
+        zfp.close()
+    writer.join()
+    return dirs
+
+def unpack(path, destdir, strip=0, nthreads=None):
+    '''
+    Unpack the archive at path into destdir after removing strip
+    leading components from each entry.  Return the number of bytes
+    written.
+    '''
+    kind,comp = archive_type(path)
+    writer = Writer(nthreads or threads)
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir)
+    try:
+        if kind == 'zip':
+            dirs = unpack_zip(path, destdir, strip, writer)
+        else:
+            dirs = unpack_tar(path, comp, destdir, strip, writer)
+    except:
+        writer.abort()
+        raise
+
+    # directory times last as creating their files changed them
+    dirs.reverse()
+    for out,mode,mtime in dirs:
+        finish(out, mode, mtime)
+        continue
+    trace.count('written', writer.nbytes)
+    return writer.nbytes
+
@@ -2,6 +2,7 @@
 
 import os
 import platform
+from UserList import UserList
 
 def guess_platform():
     if os.environ.has_key('PLATFORM'):
@@ -15,17 +16,112 @@ def guess_platform():
 
     return '-'.join(plat)
 
+def is_path_var(key):
+    'Return True if the variable named key holds a PATH-like list'
+    return len(key) >= 4 and key[-4:] == 'PATH'
+
+class PathList(UserList):
+    '''
+    The ordered, duplicate-free entries of a PATH-like variable.
+
+    It can be made from a ':'-separated string or any sequence and is
+    only split when its entries are needed; until then converting it
+    to a string gives back the string as given.  Otherwise it gives
+    the ':'-joined entries, which are kept until the entries change.
+    It is a UserList so SCons treats it like any other path list.
+
+    Combining with prepended() builds a new PathList and leaves both
+    operands alone so lists shared between environments are safe.
+    '''
+    def __init__(self, paths=None):
+        self._str = None
+        self._list = None
+        if paths is None:
+            self._list = []
+        elif isinstance(paths, PathList):
+            self._str = paths._str
+            if paths._list is not None:
+                self._list = list(paths._list)
+                pass
+        elif isinstance(paths, basestring):
+            self._str = paths
+        else:
+            self._list = unique(paths)
+            pass
+        return
+
+    def _get_data(self):
+        if self._list is None:
+            if self._str:
+                self._list = unique(self._str.split(':'))
+            else:
+                self._list = []
+                pass
+            pass
+        self._str = None        # caller may change the entries
+        return self._list
+
+    def _set_data(self, paths):
+        self._list = unique(paths)
+        self._str = None
+        return
+
+    data = property(_get_data, _set_data)
+
+    def __str__(self):
+        if self._str is None:
+            self._str = ':'.join(self._list or [])
+        return self._str
+
+    def __semi_deepcopy__(self):
+        'Called by SCons when cloning an environment'
+        return PathList(self)
+
+    def prepended(self, other):
+        '''
+        Return a new PathList with the entries of other first followed
+        by those of this one not in other.
+        '''
+        ret = PathList(other)
+        first = ret.data
+        seen = set(first)
+        ret.data = first + [p for p in self.data if p not in seen]
+        return ret
+
+    pass
+
+def as_pathlist(val):
+    'Return val as a PathList, as is if it already is one'
+    if isinstance(val, PathList):
+        return val
+    return PathList(val)
+
+def unique(paths):
+    'Return a list of the paths in order with duplicates dropped'
+    seen = set()
+    ret = []
+    for path in paths:
+        if path in seen: continue
+        seen.add(path)
+        ret.append(path)
+        continue
+    return ret
+
 def fix_env(env):
     '''
     Fix up the construction environment.  
     '''
 
-    # make sure all PATH variables are lists.
+    # make sure all PATH variables are PathLists.
     for key,val in env.Dictionary().iteritems():
-        if len(key) < 4 or key[-4:] != 'PATH':
+        if not is_path_var(key):
             continue
-        if type(val) == str:
-            env[key] = val.split(':')
+        env[key] = as_pathlist(val)
+        continue
+    penv = env['ENV']
+    for key,val in penv.items():
+        if is_path_var(key):
+            penv[key] = as_pathlist(val)
         continue
 
     # Pass through some proxy related variables from user's
@@ -48,37 +144,16 @@ def merge_dict(dst,src):
             pass
         
         if not dst.has_key(key):
+            if is_path_var(key):
+                val = as_pathlist(val)
             dst[key] = val
             continue
         
-        if len(key) < 4 or key[-4:] != 'PATH':
+        if not is_path_var(key):
             continue        # keep d's variable value
         
-        # prepend, respecting if is string or list
-        stringify = False
-        lhs = dst[key]
-        if type(lhs) == str:
-            stringify = True
-            lhs = lhs.split(':')
-            pass
-        if type(val) == str:
-            val = val.split(':')
-            pass
-
-        toadd = []
-        for thing in val:
-            toadd.append(thing)
-            if thing in lhs:
-                lhs.remove(thing)
-                pass
-            continue
-        lhs = toadd + lhs
-
-        if stringify:
-            lhs = ':'.join(lhs)
-            pass
-
-        dst[key] = lhs
+        # prepend, dropping any entries repeated further on
+        dst[key] = as_pathlist(dst[key]).prepended(val)
         continue
     return
 
@@ -96,15 +171,53 @@ def merge_env(dst,src):
     merge_dict(dst.Dictionary(), src.Dictionary())
     return
 
+def topological_order(pobjs):
+    '''
+    Return the given package objects and all they depend on (through
+    their .depobjs) ordered so each object follows its dependencies.
+    '''
+    order = []
+    seen = set()
+    for top in pobjs:
+        if id(top) in seen: continue
+        seen.add(id(top))
+        stack = [(top, iter(top.depobjs))]
+        while stack:
+            pobj, deps = stack[-1]
+            for dep in deps:
+                if id(dep) in seen: continue
+                seen.add(id(dep))
+                stack.append((dep, iter(dep.depobjs)))
+                break
+            else:
+                stack.pop()
+                order.append(pobj)
+            continue
+        continue
+    return order
+
+def merge_env_graph(pobjs):
+    '''
+    Merge into the .env of the given package objects, and all they
+    depend on, the environments of their dependencies.  Each package
+    is visited once, after its dependencies, so their environments
+    are already complete when merged and are never merged again.  The
+    result is the same as recursive_merge_env() on each object.
+    '''
+    for pobj in topological_order(pobjs):
+        for dep in pobj.depobjs:
+            merge_env(pobj.env,dep.env)
+            continue
+        continue
+    return
+
 def recursive_merge_env(pobj):
     '''
     Descend any dependencies of the given package object and merge_env
     their .env environments
     '''
-    for dep in pobj.depobjs:
-        recursive_merge_env(dep)
-        merge_env(pobj.env,dep.env)
-        continue
+    merge_env_graph([pobj])
+    return
 
 def resolve_packages(pkgs):
     if type(pkgs) == list:
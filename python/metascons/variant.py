@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+'''
+Build variants
+==============
+
+The "variants" item lists build variants (eg, "opt dbg" or several
+compilers) to build all packages in, together, in one run.  Each may
+have a section of the configuration file:
+
+  [variant dbg]
+  platform = %(platform)s-dbg
+  cflags = -g -O0
+  cxxflags = -g -O0
+
+"platform" is the variant's PLATFORM, by default the platform with
+"-NAME" added, and so where it is installed.  Any other item is set, in
+upper case, in the ENV of the variant's packages.
+
+A package is downloaded and unpacked once, as without variants, into
+BUILD_AREA/NAME-VERSION.  Each variant's build tree,
+BUILD_AREA/VARIANT/NAME-VERSION, is then made as a copy of that, not
+by unpacking again, and prepared, built and installed on its own.  In
+the build a package in a variant is known as NAME@VARIANT and depends
+on its dependencies in the same variant.
+
+Files are copied with reflinks, which share their data until either
+copy is written, where the file system supports it (eg, btrfs, XFS).
+Otherwise, with the "link" mode files are hard linked, which takes no
+space but means a build writing to a source file in place changes it
+for all variants, and with the "reflink" mode (the default) they are
+copied.
+'''
+
+import os
+import errno
+import fcntl
+import shutil
+
+from metascons.manifest import metadir
+
+FICLONE = 0x40049409            # from linux/fs.h
+
+class Variant(object):
+    'A build variant: its name, PLATFORM and ENV settings'
+    def __init__(self, name, platform, env=None):
+        self.name = name
+        self.platform = platform
+        self.env = env or {}
+        return
+
+    def key(self, pname):
+        'Return the name of the package in this variant'
+        return '%s@%s' % (pname, self.name)
+
+    pass
+
+def split_key(key):
+    'Return the package name and variant name (or None) of a package key'
+    if '@' not in key:
+        return key, None
+    return tuple(key.split('@', 1))
+
+def read_variants(cfg, names, platform):
+    '''
+    Return the Variants of the given names, taking their settings from
+    the [variant NAME] sections of the ConfigParser.
+    '''
+    ret = []
+    for name in names:
+        section = 'variant ' + name
+        vplatform = '%s-%s' % (platform, name)
+        env = {}
+        if cfg.has_section(section):
+            for item in cfg.options(section):
+                value = cfg.get(section, item, vars={'platform': platform})
+                if item == 'platform':
+                    vplatform = value
+                else:
+                    env[item.upper()] = value
+                continue
+            pass
+        ret.append(Variant(name, vplatform, env))
+        continue
+    return ret
+
+def clone_file(src, dst, mode):
+    '''
+    Make dst a copy of the regular file src, a reflink if possible,
+    otherwise a hard link if mode is "link" or a plain copy.  Return
+    how it was made.
+    '''
+    if mode != 'copy':
+        sfd = os.open(src, os.O_RDONLY)
+        try:
+            dfd = os.open(dst, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0600)
+            try:
+                fcntl.ioctl(dfd, FICLONE, sfd)
+                done = 'reflink'
+            except (IOError, OSError):
+                done = None
+            finally:
+                os.close(dfd)
+        finally:
+            os.close(sfd)
+        if done:
+            shutil.copystat(src, dst)
+            return done
+        os.remove(dst)
+        if mode == 'link':
+            try:
+                os.link(src, dst)
+                return 'link'
+            except OSError, err:
+                if err.errno not in [errno.EXDEV, errno.EMLINK, errno.EPERM]:
+                    raise
+                pass
+            pass
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def empty(path):
+    '''
+    Remove the directory at path or, if it is a link (eg, to a scratch
+    area), what is in the directory it points to.
+    '''
+    if not os.path.islink(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        return
+    path = os.path.realpath(path)
+    if not os.path.isdir(path): return
+    for name in os.listdir(path):
+        sub = os.path.join(path, name)
+        if os.path.isdir(sub) and not os.path.islink(sub):
+            shutil.rmtree(sub)
+        else:
+            os.remove(sub)
+        continue
+    return
+
+def clone_tree(src, dst, mode='reflink'):
+    '''
+    Make dst a copy of the directory src, without its .metascons
+    directory, by clone_file() in the given mode.  What was in dst is
+    removed first.  Return a dictionary counting how files were made.
+    '''
+    empty(dst)
+    counts = {}
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        if dirpath == src and metadir in dirnames:
+            dirnames.remove(metadir)
+        out = os.path.normpath(os.path.join(dst, os.path.relpath(dirpath, src)))
+        if not os.path.isdir(out):
+            os.makedirs(out)
+        for name in dirnames[:]:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                dirnames.remove(name)
+                os.symlink(os.readlink(path), os.path.join(out, name))
+            continue
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            target = os.path.join(out, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target)
+                how = 'symlink'
+            else:
+                how = clone_file(path, target, mode)
+            counts[how] = counts.get(how, 0) + 1
+            continue
+        dirs.append((dirpath, out))
+        continue
+    for dirpath, out in reversed(dirs):  # after their contents are made
+        shutil.copystat(dirpath, out)
+        continue
+    return counts
+
+class CloneAction(object):
+    '''
+    A SCons function action making a variant's build tree as a copy of
+    the unpacked source and then its unpack target, if the copy did
+    not bring it along.
+    '''
+    def __init__(self, src, dst, marker, mode='reflink'):
+        self.src = src
+        self.dst = dst
+        self.marker = marker
+        self.mode = mode
+        return
+
+    def __call__(self, target, source, env):
+        import time
+        counts = clone_tree(self.src, self.dst, self.mode)
+        if not os.path.isdir(os.path.join(self.dst, metadir)):
+            os.makedirs(os.path.join(self.dst, metadir))
+        print 'Copied %s to %s: %s' % \
+            (self.src, self.dst, ', '.join('%d %s' % (counts[how], how) \
+                                               for how in sorted(counts)))
+        if not os.path.exists(self.marker):
+            fp = open(self.marker,'w')
+            fp.write(time.ctime() + '\n')
+            fp.close()
+        return
+
+    def strfunction(self, target, source, env):
+        return None
+
+    def get_contents(self, target, source, env):
+        return 'clone %s %s %s' % (self.src, self.dst, self.mode)
+
+    pass
@@ -142,6 +142,8 @@ full environment.  PATH-like values should stored as lists.
 '''
 
 import os
+import re
+from metascons.util import PathList, as_pathlist
 
 class MetaSconsWrapper(object):
     '''
@@ -203,6 +205,15 @@ class MetaSconsWrapper(object):
         '''
         return os.path.join(self.env['TAR_FILES'], self.tarballname())
 
+    def tarballsha256(self):
+        '''
+        Return the expected hex SHA-256 digest of the tarball or None
+        if it is not known.  If omitted it is taken from NAME_SHA256
+        from the environment (ie, as set by "name_sha256" in the
+        versions section of the configuration file).
+        '''
+        return self.env.get(self.name().upper() + '_SHA256')
+
     def sourcedir(self):
         '''
         Define the location of the unpacked source, that is, what
@@ -213,6 +224,15 @@ class MetaSconsWrapper(object):
         return os.path.join(self.env['BUILD_AREA'], 
                             self.name() + '-' + self.version())
 
+    def unpack_strip(self):
+        '''
+        Return the number of leading path components to remove from
+        the entries in the tarball.  If nonzero, what remains is
+        unpacked directly into sourcedir().  This is for tarballs that
+        do not unpack to sourcedir().  The default is 0.
+        '''
+        return 0
+
     def installdir(self):
         '''
         Define the local filesystem directory where this package is
@@ -230,6 +250,49 @@ class MetaSconsWrapper(object):
         return {}
 
 
+    ## recipes: ##
+
+    # stanza action names and the stages they describe
+    recipe_stages = [('download','download'), ('unpack','unpack'),
+                     ('configure','prepare'), ('prepare','prepare'),
+                     ('build','build'), ('install','install')]
+
+    def use_recipes(self, index, suite=None):
+        '''
+        Take the target and action of stages from the stanzas in the
+        index (see metascons.stanza) that apply to this version of the
+        package, overriding the *_target and *_action methods.  A
+        stanza's "creates" is relative to the tarball directory for
+        download, the install directory for install and the source
+        directory otherwise.  Return the names of the stages affected.
+        '''
+        values = {'name': self.name(), 'package': self.name(),
+                  'version': self.version(), 'sourcedir': self.sourcedir(),
+                  'installdir': self.installdir(),
+                  'tarballname': self.tarballname(),
+                  'tarballpath': self.tarballpath(),
+                  'tarballurl': self.tarballurl(),
+                  'platform': self.env['PLATFORM'],
+                  'suite': suite and suite.name or '',
+                  'tags': suite and ' '.join(suite.tags) or ''}
+        outdirs = {'download': os.path.dirname(self.tarballpath()),
+                   'install': self.installdir()}
+        ret = []
+        for action,stage in self.recipe_stages:
+            stanza = index.resolve(action, self.name(), self.version())
+            if not stanza: continue
+            if not stanza.items.has_key('creates'):
+                raise ValueError('Stanza [%s] lacks "creates"' % stanza.name())
+            target = os.path.join(outdirs.get(stage, self.sourcedir()),
+                                  stanza.get('creates', values))
+            setattr(self, stage + '_target', lambda target=target: target)
+            if stanza.items.has_key('command'):
+                command = stanza.get('command', values)
+                setattr(self, stage + '_action', lambda command=command: command)
+            ret.append(stage)
+            continue
+        return ret
+
     ## targets: ##
 
     def download_target(self):
@@ -279,47 +342,100 @@ class MetaSconsWrapper(object):
         return os.path.join(self.installdir(),'setup-' + self.name() + '.sh')
 
 
+    def stamp_targets(self):
+        '''
+        Return the stage target files that only mark that the stage
+        ran (eg, hold the time) rather than being part of what it made.
+        They are left out of the stage manifests (see
+        metascons.manifest).  By default these are the setup script and
+        the targets of the default unpack action and of actions that
+        write "date > $TARGET".
+        '''
+        ret = [self.environment_target()]
+        for stage in ['unpack','prepare','build','install']:
+            action = getattr(self, stage + '_action')()
+            if action == self.do_unpack_action or \
+                    (isinstance(action, basestring) and \
+                         re.search(r'\bdate\s*>\s*\$\{?TARGET\b', action)):
+                ret.append(getattr(self, stage + '_target')())
+            continue
+        return ret
+
+
     ## actions ##
 
+    def do_download_action(self,target,source,env):
+        '''
+        Download tarballurl() to download_target() with the built-in
+        downloader (see metascons.download).  The SHA-256 digest is
+        computed as the data streams in and checked against any
+        tarballsha256() before the tarball is put in place.  If
+        TARBALL_STORE is set the tarball becomes a link into that
+        content-addressed store (see metascons.store) and a tarball
+        already held there is linked without downloading.
+        '''
+        import hashlib
+        from metascons import download, store
+
+        path = self.download_target()
+        expected = self.tarballsha256()
+        cas = store.tarball_store(env)
+        if cas and expected and cas.has(expected):
+            cas.link(expected, path)
+            return
+
+        hasher = hashlib.sha256()
+        download.fetch(self.tarballurl(), path, hasher, expected)
+        if cas:
+            cas.add(path, hasher.hexdigest())
+        return
+
     def download_action(self):
         '''
         Provide the action to download the tarball.  The default will
-        download it based on tarballurl().  The download_target() is
-        assumed to be the final resting spot for the tarball.
+        download it based on tarballurl() using connections shared
+        with all other downloads.  The download_target() is assumed to
+        be the final resting spot for the tarball.
         '''
-        import tempfile
-        tdir = tempfile.mkdtemp()
-        tfile = os.path.join(tdir,os.path.basename(self.tarballname()))
+        return self.do_download_action
 
-        return "cd $TAR_FILES && wget %s" % self.tarballurl()
-         
 
-    def unpack_action(self):
+    def do_unpack_action(self,target,source,env):
         '''
-        Provide the action to unpack the tarball producing the sourcedir.
-        The default handles .zip, .tar.gz, .tgz, .tar.bz2 and will unpack
-        from the BUILD_AREA and assumes the result produces the expected
-        sourcedir.  It produdes the output target as described above.
+        Unpack the tarball with the built-in unpacker (see
+        metascons.unpack) and produce the unpack_target().
         '''
+        import time
+        from metascons import unpack
+
+        marker = self.unpack_target()
+        if os.path.exists(marker):
+            os.remove(marker)
 
-        tb = self.tarballname()
-        ext = os.path.splitext(tb)[1]
-        cmd = "rm -f %s ; cd $BUILD_AREA ; " % self.unpack_target()
-        if ".zip" == ext:
-            cmd += "unzip %s " % self.tarballpath()
+        strip = self.unpack_strip()
+        if strip:
+            destdir = self.sourcedir()
         else:
-            # assume it is a tar file
-            tar = "tar -x"
-            if ext in ['.gz','.tgz']:
-                tar += " -z "
-            elif ext in ['.bz2']:
-                tar += " -j "
-                pass
-            tar += " -f %s " % self.tarballpath()
-            cmd += tar
-            pass
-        cmd += " && date > %s" % self.unpack_target()
-        return cmd
+            destdir = env['BUILD_AREA']
+        unpack.unpack(self.tarballpath(), destdir, strip)
+
+        if not os.path.isdir(self.sourcedir()):
+            raise IOError('Unpacking %s did not produce %s' % \
+                              (self.tarballpath(), self.sourcedir()))
+        fp = open(marker,'w')
+        fp.write(time.ctime() + '\n')
+        fp.close()
+        return
+
+    def unpack_action(self):
+        '''
+        Provide the action to unpack the tarball producing the sourcedir.
+        The default handles .zip, .tar, .tar.gz, .tgz, .tar.bz2 and
+        .tar.xz.  It unpacks into the BUILD_AREA and assumes the result
+        produces the expected sourcedir unless unpack_strip() is
+        nonzero.  It produces the output target as described above.
+        '''
+        return self.do_unpack_action
 
     def prepare_action(self):
         '''
@@ -342,9 +458,33 @@ class MetaSconsWrapper(object):
         '''
         return "date > $TARGET"
 
+    def setup_environment(self):
+        '''
+        Return the environment of this package merged with that of all
+        the packages it depends on, directly or not, as a list of
+        (name,value) pairs.  The merge gives what sourcing the setup
+        scripts of the dependencies in dependency order and then
+        applying this package's environment() would, except that
+        PATH-like values hold each entry only once.
+        '''
+        from metascons.util import topological_order
+        merged = {}
+        for pobj in topological_order([self]):
+            for key,val in pobj.environment().iteritems():
+                if isinstance(val,(list,PathList)):
+                    val = as_pathlist(merged.get(key)).prepended(val)
+                merged[key] = val
+                continue
+            continue
+        return sorted(merged.items())
+
     def do_environment_action(self,target,source,env):
         '''
-        Generate setup scripts for this package.
+        Generate setup scripts for this package.  By default each
+        holds the flattened setup_environment() so a shell reads just
+        one file.  If ENVIRONMENT_SCRIPTS is "chained" each instead
+        sources the scripts of the direct dependencies and then applies
+        this package's environment().
         '''
 
         bs_name = self.environment_target()
@@ -357,19 +497,24 @@ class MetaSconsWrapper(object):
         bs_fp.write(head % ('sh',self.name()))
         cs_fp.write(head % ('csh',self.name()))
 
-        for depobj in self.depobjs:
-            other_bs_name = depobj.environment_target()
-            other_cs_name = os.path.splitext(other_bs_name)[0] + '.csh'
+        if env.get('ENVIRONMENT_SCRIPTS') == 'chained':
+            for depobj in self.depobjs:
+                other_bs_name = depobj.environment_target()
+                other_cs_name = os.path.splitext(other_bs_name)[0] + '.csh'
 
-            line = 'source %s\n'
-            bs_fp.write(line % other_bs_name)
-            cs_fp.write(line % other_cs_name)
+                line = 'source %s\n'
+                bs_fp.write(line % other_bs_name)
+                cs_fp.write(line % other_cs_name)
 
-            continue
+                continue
+            items = self.environment().items()
+        else:
+            items = self.setup_environment()
+            pass
 
-        for key,val in self.environment().iteritems():
-            if isinstance(val,list):
-                val = ':'.join(val)
+        for key,val in items:
+            if isinstance(val,(list,PathList)):
+                val = str(as_pathlist(val))
                 # prepend to existing var
                 bs_fp.write('export %s=%s${%s:+:$%s}\n' % (key,val,key,key))
                 cs_fp.write('''
@@ -384,6 +529,8 @@ endif
             cs_fp.write('setenv %s "%s"\n' % (key,val))
             continue
 
+        bs_fp.close()
+        cs_fp.close()
         return
 
     def environment_action(self):
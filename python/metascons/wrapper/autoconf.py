@@ -8,6 +8,7 @@ This class extends the interface to allow subclasses to provide
 
 import os
 from metascons.wrapper import MetaSconsWrapper
+from metascons import confcache
 
 class AutoconfWrapper(MetaSconsWrapper):
 
@@ -17,9 +18,37 @@ class AutoconfWrapper(MetaSconsWrapper):
         'Return any options to add to configure'
         return ""
 
+    def configure_cache(self):
+        '''
+        Return True if configure may share results with the other
+        packages through the suite's configure cache (see
+        metascons.confcache).  Override to return False if the
+        package's configure is not autoconf or its probes conflict.
+        '''
+        return True
+
+    def configure_cache_drop(self):
+        '''
+        Return glob patterns of configure cache variables the package
+        must always probe for itself.
+        '''
+        return []
+
+    def configure_command(self):
+        'Return the command running configure'
+        shared = self.env.get('CONFIGURE_CACHE')
+        wrap = ''
+        if shared and self.configure_cache():
+            wrap = confcache.command(shared, self.configure_cache_drop())
+        # the cache is kept out of the action signature
+        return '$( %s $) ./configure' % wrap
+
     def build_options(self):
-        'Return any options passed to make during build'
-        return ""
+        '''
+        Return any options passed to make during build.  The default
+        runs as many jobs as slots given by the CPU budget scheduler.
+        '''
+        return "$( -j$MAKE_JOBS $)"
 
     def install_options(self):
         'Return any options passed to "make install"'
@@ -31,7 +60,8 @@ class AutoconfWrapper(MetaSconsWrapper):
         return os.path.join(self.sourcedir(), 'config.status')
 
     def prepare_action(self):
-        return 'cd %s && ./configure %s' % (self.sourcedir(), self.prepare_options())
+        return 'cd %s && %s %s' % (self.sourcedir(), self.configure_command(),
+                                   self.prepare_options())
 
     def build_target(self):
         return os.path.join(self.sourcedir(), 'src/%s'%self.name())
@@ -43,7 +73,7 @@ class AutoconfWrapper(MetaSconsWrapper):
         return os.path.join(self.installdir(),'bin/%s' % self.name())
 
     def install_action(self):
-        return "cd $%s_SOURCEDIR && make %s install" % \
+        return "cd $%s_SOURCEDIR && make $( -j$MAKE_JOBS $) %s install" % \
             (self.name().upper(), self.install_options())
 
     pass
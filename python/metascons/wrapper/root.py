@@ -20,6 +20,10 @@ class RootWrapper(AutoconfWrapper):
         return '--with-python-incdir=%s/include --with-python-libdir=%s/lib' % \
             (inst,inst)
 
+    def configure_cache(self):
+        'ROOT\'s configure does not take --cache-file'
+        return False
+
     def tarballname(self):
         return 'root_v%s.source.tar.gz' % self.env['ROOT_VERSION']
 
@@ -27,15 +31,9 @@ class RootWrapper(AutoconfWrapper):
         urlpatt = 'ftp://root.cern.ch/root/%s'
         return urlpatt % self.tarballname()
 
-    def unpack_action(self):
+    def unpack_strip(self):
         "Root's tarball unpacks to just root/"
-        act = AutoconfWrapper.unpack_action(self)
-        cmds = act.split('&&')
-        mvcmd = 'mv root/* %s && rmdir root ' % self.sourcedir()
-        cmds.insert(-1, mvcmd)
-        ret = ' && '.join(cmds)
-        print ret
-        return ret
+        return 1
 
     pass
 